@@ -0,0 +1,223 @@
+"""
+inference.py 客户端吞吐基准测试
+
+启动本地模拟服务（mock_server.py），用自带的测试集分别以不同的并发模式
+运行，报告每种模式的样本/s、每个样本的 CPU 时间和峰值内存，不需要 GPU。
+
+模式写法:
+    client       在本进程中顺序调用 VLMessageClient.process_item，测量单个请求的客户端开销
+    process:N    完整运行 inference.py main()，多进程引擎，N 个工作进程
+    async:N      完整运行 inference.py main()，async 引擎，最大在途请求数 N
+
+图像优先从 Geo170K.zip 中解压，压缩包中没有的图像（如 geometry3k）生成占位图。
+--inference_args 会原样传给 inference.py，可用来对比不同的图像编码策略。
+
+用法:
+    python3 benchmark_inference.py --modes client process:5 async:64 --latency 0.2 --jitter 0.1
+    python3 benchmark_inference.py --modes async:64 --inference_args "--max_pixels 262144 --image_quality 85"
+"""
+import argparse
+import json
+import os
+import resource
+import shlex
+import socket
+import subprocess
+import sys
+import time
+import zipfile
+from PIL import Image, ImageDraw
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+from inference import RunMetrics, VLMessageClient, iter_prompts, resolve_image_path
+
+DEFAULT_PROMPTS = [
+    os.path.join(SCRIPT_DIR, "geoqa_test_prompts.jsonl"),
+    os.path.join(SCRIPT_DIR, "geometry3k_test_prompts.jsonl"),
+]
+
+def prepare_prompts(prompt_path, work_dir, limit):
+    """limit 不为空时截取前 limit 条写到工作目录，返回实际使用的测试集路径"""
+    if not limit:
+        return prompt_path
+    limited_path = os.path.join(work_dir, f"{os.path.splitext(os.path.basename(prompt_path))[0]}_{limit}.jsonl")
+    with open(prompt_path, "r", encoding="utf-8") as src, open(limited_path, "w", encoding="utf-8") as dst:
+        for count, line in enumerate(l for l in src if l.strip()):
+            if count >= limit:
+                break
+            dst.write(line)
+    return limited_path
+
+def prepare_image_root(prompt_paths, image_root):
+    """在 image_root 下准备测试集引用的全部图像，返回 (解压数, 占位图数)"""
+    zip_path = os.path.join(SCRIPT_DIR, "Geo170K.zip")
+    archive = zipfile.ZipFile(zip_path) if os.path.exists(zip_path) else None
+    members = set(archive.namelist()) if archive is not None else set()
+    extracted = placeholders = 0
+    try:
+        for prompt_path in prompt_paths:
+            for item in iter_prompts(prompt_path):
+                image_path = resolve_image_path(item, image_root)
+                if os.path.exists(image_path):
+                    continue
+                os.makedirs(os.path.dirname(image_path), exist_ok=True)
+                member = item["image_path"].lstrip("./")
+                if member in members:
+                    with archive.open(member) as src, open(image_path, "wb") as dst:
+                        dst.write(src.read())
+                    extracted += 1
+                else:
+                    image = Image.new("RGB", (320, 240), "white")
+                    draw = ImageDraw.Draw(image)
+                    draw.polygon([(40, 200), (280, 200), (160, 40)], outline="black")
+                    image.save(image_path)
+                    placeholders += 1
+    finally:
+        if archive is not None:
+            archive.close()
+    return extracted, placeholders
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_mock_server(args, extra_args=()):
+    """在子进程中启动模拟服务（其 CPU 开销不计入客户端），返回 (进程, 地址)"""
+    port = free_port()
+    cmd = [
+        sys.executable, os.path.join(SCRIPT_DIR, "mock_server.py"), "--port", str(port),
+        "--latency", str(args.latency), "--jitter", str(args.jitter), "--error_rate", str(args.error_rate),
+        "--output_tokens", str(args.output_tokens), "--model_name", args.model_name, *extra_args
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return proc, url
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("模拟服务启动失败")
+
+def run_client(url, prompt_path, image_root, model_name):
+    """本进程内顺序调用 process_item，返回 (样本数, 耗时, CPU 秒数, 峰值内存 KB, 性能汇总)"""
+    client = VLMessageClient(url, model_name)
+    items = list(iter_prompts(prompt_path))
+    metrics = RunMetrics(0)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for item in items:
+        metrics.observe(client.process_item(item, image_root))
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    return len(items), wall, cpu, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, metrics.summary()
+
+def run_main(url, prompt_path, image_root, model_name, engine, workers, work_dir, extra_args=()):
+    """在子进程中完整运行 inference.py main()，返回 (样本数, 耗时, CPU 秒数, 峰值内存 KB, 性能汇总)
+
+    CPU 时间包含主进程及其全部工作进程；峰值内存为其中最大的单个进程。
+    """
+    name = f"{os.path.splitext(os.path.basename(prompt_path))[0]}_{engine}_{workers}"
+    output_path = os.path.join(work_dir, f"results_{name}.jsonl")
+    stem = os.path.splitext(output_path)[0]
+    for path in (output_path, stem + "_errors.jsonl", stem + "_index.tsv", stem + "_stats.json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+    cmd = [
+        sys.executable, os.path.join(SCRIPT_DIR, "inference.py"),
+        "--api_url", url, "--model_name", model_name, "--prompt_path", prompt_path,
+        "--image_root", image_root, "--output_path", output_path, "--engine", engine,
+        "--report_interval", "0",
+        "--max_workers" if engine == "process" else "--concurrency", str(workers), *extra_args
+    ]
+    wall_start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - wall_start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"inference.py 运行失败: {' '.join(cmd)}")
+
+    with open(stem + "_stats.json", "r") as f:
+        stats = json.load(f)
+    items = stats["successful_inferences"] + stats["failed_inferences"]
+    return items, wall, usage.ru_utime + usage.ru_stime, usage.ru_maxrss, stats["performance"]
+
+def main():
+    parser = argparse.ArgumentParser(description="inference.py 客户端吞吐基准测试（使用本地模拟服务）")
+    parser.add_argument("--prompt_path", nargs="+", default=DEFAULT_PROMPTS, help="测试集路径，默认使用自带的两个测试集")
+    parser.add_argument("--modes", nargs="+", default=["client", "process:5", "async:64"],
+                        help="并发模式: client、process:N、async:N")
+    parser.add_argument("--limit", type=int, default=None, help="每个测试集最多使用的样本数")
+    parser.add_argument("--work_dir", default="./benchmark_work", help="图像、截取的测试集和输出的工作目录")
+    parser.add_argument("--image_root", default=None, help="图像根目录，默认在工作目录下准备")
+    parser.add_argument("--model_name", default="mock-model", help="请求中的模型名")
+    parser.add_argument("--latency", type=float, default=0.1, help="模拟服务的平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.05, help="模拟服务的延迟抖动（秒）")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="模拟服务返回错误的概率")
+    parser.add_argument("--output_tokens", type=int, default=256, help="模拟服务每个回答的 token 数")
+    parser.add_argument("--inference_args", default="",
+                        help="原样传给 inference.py 的额外参数，例如 \"--max_pixels 262144 --image_format WEBP\"")
+    parser.add_argument("--output_json", default=None, help="基准结果写入的 JSON 文件")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    prompt_paths = [prepare_prompts(p, args.work_dir, args.limit) for p in args.prompt_path]
+    image_root = args.image_root or os.path.join(args.work_dir, "images")
+    extracted, placeholders = prepare_image_root(prompt_paths, image_root)
+    print(f"图像根目录: {image_root} (新解压 {extracted} 张，占位图 {placeholders} 张)")
+
+    server, url = start_mock_server(args)
+    print(f"模拟服务: {url} (延迟 {args.latency}s ± {args.jitter}s，错误率 {args.error_rate}，"
+          f"输出 {args.output_tokens} tokens)")
+
+    results = []
+    try:
+        for mode in args.modes:
+            engine, _, workers = mode.partition(":")
+            for prompt_path in prompt_paths:
+                if engine == "client":
+                    items, wall, cpu, peak_kb, performance = run_client(url, prompt_path, image_root,
+                                                                        args.model_name)
+                else:
+                    items, wall, cpu, peak_kb, performance = run_main(
+                        url, prompt_path, image_root, args.model_name, engine, int(workers), args.work_dir,
+                        shlex.split(args.inference_args)
+                    )
+                result = {
+                    "mode": mode,
+                    "dataset": os.path.basename(prompt_path),
+                    "items": items,
+                    "wall_seconds": round(wall, 3),
+                    "items_per_second": round(items / wall, 2) if wall > 0 else None,
+                    "cpu_ms_per_item": round(cpu / items * 1000, 3) if items else None,
+                    "peak_rss_mb": round(peak_kb / 1024, 1),
+                    "request_kb_mean": round((performance["request_bytes_mean"] or 0) / 1024, 1),
+                    "latency_p50": performance["http_latency"]["p50"],
+                    "latency_p95": performance["http_latency"]["p95"]
+                }
+                results.append(result)
+                print(f"{mode:<12} {result['dataset']:<34} {items:>6} 条  {result['wall_seconds']:>8.2f}s  "
+                      f"{result['items_per_second']:>8.2f} 条/s  CPU {result['cpu_ms_per_item']:>8.2f} ms/条  "
+                      f"峰值内存 {result['peak_rss_mb']:>7.1f} MB  请求体 {result['request_kb_mean']:>7.1f} KB  "
+                      f"延迟 p50 {result['latency_p50']}s p95 {result['latency_p95']}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump({
+                "latency": args.latency,
+                "jitter": args.jitter,
+                "error_rate": args.error_rate,
+                "output_tokens": args.output_tokens,
+                "inference_args": args.inference_args,
+                "results": results
+            }, f, indent=4)
+        print(f"基准结果已保存到: {args.output_json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+首 token 延迟（TTFT）基准测试：对比共用前缀与不共用前缀
+
+inference.py 的每个请求都以相同的系统消息开头，vLLM 开启自动前缀缓存
+（vllm_server.sh 中的 --enable-prefix-caching）后，这部分的 KV 在所有样本
+之间复用，只需预填充样本自己的图像和问题。本脚本用流式请求测量同一批
+样本在两种情况下的 TTFT：
+
+    shared   系统消息前加本次运行共用的随机串：同一次运行内所有请求前缀相同，
+             不同次运行之间不会命中上一次留下的缓存
+    unique   系统消息前加每个请求各自的随机串：前缀互不相同，无法复用缓存
+
+两种模式的提示长度相同，差别只在于前缀能否复用。不指定 --api_url 时自动启动
+mock_server.py，以 --prefill_per_token 模拟预填充耗时并开启前缀缓存模拟。
+
+用法:
+    python3 benchmark_ttft.py --limit 50
+    python3 benchmark_ttft.py --api_url http://localhost:8000 --model_name GeoThought --limit 200
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import uuid
+import requests
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+from benchmark_inference import prepare_image_root, prepare_prompts, start_mock_server
+from inference import JSON_HEADERS, SYSTEM_PROMPT, VLMessageClient, _percentile, iter_prompts
+
+MODES = ("unique", "shared")
+
+def build_stream_payload(client, item, image_root, nonce, max_tokens):
+    """构建流式请求体，系统消息前加上 nonce"""
+    payload = client.build_payload(item, image_root)
+    payload["messages"][0] = {"role": "system", "content": f"[{nonce}] {SYSTEM_PROMPT}"}
+    payload["max_tokens"] = max_tokens
+    payload["stream"] = True
+    payload["stream_options"] = {"include_usage": True}
+    return payload
+
+def measure_ttft(session, url, payload, timeout):
+    """发送流式请求，返回 (首 token 延迟, 总耗时, 命中前缀缓存的 token 数)"""
+    start = time.perf_counter()
+    ttft = None
+    cached_tokens = None
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    with session.post(f"{url}/v1/chat/completions", data=body, headers=JSON_HEADERS,
+                      stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            data = line[len(b"data: "):]
+            if data == b"[DONE]":
+                break
+            chunk = json.loads(data)
+            if ttft is None and any(c.get("delta", {}).get("content") for c in chunk.get("choices", [])):
+                ttft = time.perf_counter() - start
+            usage = chunk.get("usage") or {}
+            if usage.get("prompt_tokens_details"):
+                cached_tokens = usage["prompt_tokens_details"].get("cached_tokens")
+    return ttft, time.perf_counter() - start, cached_tokens
+
+def run_mode(mode, client, items, image_root, url, args):
+    """按模式发送全部样本，返回每个请求的 (TTFT, 总耗时, 缓存 token 数) 列表"""
+    run_nonce = uuid.uuid4().hex
+
+    def nonce():
+        return uuid.uuid4().hex if mode == "unique" else run_nonce
+
+    session = requests.Session()
+    payloads = [build_stream_payload(client, item, image_root, nonce(), args.max_tokens) for item in items]
+    # 先发一个请求预热（shared 模式下同时把共用前缀写入缓存），不计入结果
+    measure_ttft(session, url, build_stream_payload(client, items[0], image_root, nonce(), args.max_tokens),
+                 args.request_timeout)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        return list(executor.map(lambda p: measure_ttft(session, url, p, args.request_timeout), payloads))
+
+def summarize(samples):
+    """汇总一种模式的 TTFT 分布、平均总耗时和平均命中缓存 token 数
+
+    百分位数与 inference.py / benchmark_inference.py 的延迟统计使用同一算法。
+    """
+    ttfts = sorted(s[0] for s in samples if s[0] is not None)
+    totals = [s[1] for s in samples]
+    cached = [s[2] for s in samples if s[2] is not None]
+
+    def percentile(q):
+        value = _percentile(ttfts, q)
+        return round(value, 4) if value is not None else None
+
+    return {
+        "requests": len(samples),
+        "ttft_mean": round(sum(ttfts) / len(ttfts), 4) if ttfts else None,
+        "ttft_p50": percentile(50),
+        "ttft_p95": percentile(95),
+        "total_mean": round(sum(totals) / len(totals), 4) if totals else None,
+        "cached_tokens_mean": round(sum(cached) / len(cached), 1) if cached else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="对比共用前缀与不共用前缀时的首 token 延迟")
+    parser.add_argument("--api_url", default=None, help="vLLM 服务地址，不指定时自动启动模拟服务")
+    parser.add_argument("--model_name", default="mock-model", help="请求中的模型名")
+    parser.add_argument("--prompt_path", default=os.path.join(SCRIPT_DIR, "geoqa_test_prompts.jsonl"),
+                        help="测试集路径")
+    parser.add_argument("--limit", type=int, default=50, help="使用的样本数")
+    parser.add_argument("--work_dir", default="./benchmark_work", help="图像和截取的测试集的工作目录")
+    parser.add_argument("--image_root", default=None, help="图像根目录，默认在工作目录下准备")
+    parser.add_argument("--max_tokens", type=int, default=16, help="每个请求最多生成的 token 数")
+    parser.add_argument("--concurrency", type=int, default=1, help="同时发送的请求数，默认逐个发送")
+    parser.add_argument("--request_timeout", type=float, default=100, help="单次请求超时（秒）")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟服务的解码耗时（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="模拟服务的延迟抖动（秒）")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="模拟服务返回错误的概率")
+    parser.add_argument("--output_tokens", type=int, default=256, help="模拟服务每个回答的 token 数")
+    parser.add_argument("--prefill_per_token", type=float, default=0.0005,
+                        help="模拟服务每个未命中缓存的提示 token 的预填充耗时（秒）")
+    parser.add_argument("--output_json", default=None, help="基准结果写入的 JSON 文件")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    prompt_path = prepare_prompts(args.prompt_path, args.work_dir, args.limit)
+    image_root = args.image_root or os.path.join(args.work_dir, "images")
+    if args.image_root is None:
+        prepare_image_root([prompt_path], image_root)
+    items = list(iter_prompts(prompt_path))
+
+    server = None
+    url = args.api_url
+    if url is None:
+        server, url = start_mock_server(args, ["--prefill_per_token", str(args.prefill_per_token),
+                                               "--prefix_caching"])
+        print(f"模拟服务: {url} (预填充 {args.prefill_per_token}s/token，已开启前缀缓存模拟)")
+    url = url.rstrip("/")
+    client = VLMessageClient(url, args.model_name)
+
+    results = {}
+    try:
+        for mode in MODES:
+            results[mode] = summarize(run_mode(mode, client, items, image_root, url, args))
+            r = results[mode]
+            print(f"{mode:<8} {r['requests']:>5} 条  TTFT 平均 {r['ttft_mean']}s p50 {r['ttft_p50']}s "
+                  f"p95 {r['ttft_p95']}s  总耗时平均 {r['total_mean']}s  命中缓存 {r['cached_tokens_mean']} tokens")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if results["shared"]["ttft_p50"] and results["unique"]["ttft_p50"]:
+        print(f"共用前缀后 TTFT p50 降低为原来的 "
+              f"{results['shared']['ttft_p50'] / results['unique']['ttft_p50']:.2%}")
+
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump({"api_url": args.api_url, "max_tokens": args.max_tokens, "concurrency": args.concurrency,
+                       "results": results}, f, indent=4)
+        print(f"基准结果已保存到: {args.output_json}")
+
+if __name__ == "__main__":
+    main()
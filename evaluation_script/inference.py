@@ -6,334 +6,1638 @@ from tqdm import tqdm
 from PIL import Image
 from io import BytesIO
 import argparse
-import pandas as pd
 import concurrent.futures
-from multiprocessing import Manager, Lock
 import time
 import re
 import sys
+import asyncio
+import functools
+import hashlib
+import itertools
+import math
+import random
+import sqlite3
+import tempfile
+import threading
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 sys.stdout.reconfigure(encoding='utf-8') if hasattr(sys.stdout, 'reconfigure') else None
 # ========================
 # 1. 辅助函数
 # ========================
+# 预编译的答案提取正则
+_ANSWER_RE = re.compile(r"<answer>\s*([\d.]+)", re.IGNORECASE)
+_NUMBER_RE = re.compile(r"\d+\.?\d*")
+_DIGIT_RE = re.compile(r"\d")
+_NUMERIC_RUN_RE = re.compile(r"[\d.]*")
+
+def _last_number(text):
+    """返回文本中最后一个数字，结果与 re.findall(r"\d+\.?\d*", text)[-1] 相同
+
+    在反转后的文本上查找最后一个数字字符及其所在的 [0-9.] 连续片段，只在该
+    片段上做正向匹配，不必扫描推理模型输出中前面成千上万个 token。
+    """
+    rev = text[::-1]
+    digit = _DIGIT_RE.search(rev)
+    if digit is None:
+        return None
+    run_start = len(text) - _NUMERIC_RUN_RE.match(rev, digit.start()).end()
+    return _NUMBER_RE.findall(text, run_start)[-1]
+
 def safe_parse(text):
     """安全解析模型输出中的答案"""
     try:
         # 尝试匹配<answer>标签
-        answer_match = re.search(r"<answer>\s*([\d.]+)", text, re.IGNORECASE)
+        answer_match = _ANSWER_RE.search(text)
         if answer_match:
             return [float(answer_match.group(1))]
 
-        # 尝试匹配文本中的数字
-        numbers = re.findall(r"\d+\.?\d*", text)
-        return [float(numbers[-1])] if numbers else None
+        # 尝试匹配文本中的最后一个数字
+        number = _last_number(text)
+        return [float(number)] if number is not None else None
     except:
         return None
 
+@functools.lru_cache(maxsize=65536)
+def _parse_ground_truth_cached(text):
+    parsed = safe_parse(text)
+    return tuple(parsed) if parsed is not None else None
+
+def parse_ground_truth(text):
+    """解析标准答案；同一标准答案只解析一次"""
+    parsed = _parse_ground_truth_cached(text) if isinstance(text, str) else safe_parse(text)
+    return list(parsed) if parsed is not None else None
+
+def parse_batch(texts, max_workers=None, chunksize=1024):
+    """批量解析答案，max_workers 大于 1 时使用多进程，结果顺序与输入一致"""
+    if not max_workers or max_workers <= 1 or len(texts) <= chunksize:
+        return [safe_parse(text) for text in texts]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(safe_parse, texts, chunksize=chunksize))
+
 def safe_verify(pred, truth, tolerance=1e-3):
     """验证预测答案是否正确"""
     if not pred or not truth:
         return 0.0
     return 1.0 if abs(pred[0] - truth[0]) < tolerance else 0.0
 
+def compute_item_id(item):
+    """由问题、图像和标准答案计算样本的内容哈希 ID"""
+    content = json.dumps(
+        [str(item["question"]), str(item["image_path"]), str(item["ground_truth"])],
+        ensure_ascii=False
+    )
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+
+def iter_prompts(prompt_path):
+    """逐行惰性读取测试集 JSONL，并为每个样本计算 item_id
+
+    多个问题共用同一张图时 item_id 也各不相同；内容完全重复的行
+    依次加上 -1、-2 后缀，保证每个样本恰好对应一条结果。
+    """
+    seen = {}
+    with open(prompt_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                item_id = compute_item_id(item)
+                dup = seen.get(item_id, 0)
+                seen[item_id] = dup + 1
+                item["item_id"] = f"{item_id}-{dup}" if dup else item_id
+                yield item
+
+def count_prompts(prompt_path):
+    """统计测试集样本数（只数非空行，不解析 JSON）"""
+    with open(prompt_path, "rb") as f:
+        return sum(1 for line in f if line.strip())
+
+def score_output(output, ground_truth):
+    """从模型输出中提取答案并与标准答案比对，返回 (预测答案, 是否正确)"""
+    gt = parse_ground_truth(ground_truth)
+    pred = safe_parse(output)
+    return pred, bool(pred and gt and safe_verify(pred, gt))
+
+def resolve_image_path(item, image_root):
+    """根据测试项和图像根目录得到图像路径"""
+    return os.path.join(image_root, item['image_path'].lstrip('./'))
+
+# 图像编码参数，同时作为编码缓存键的一部分
+IMAGE_FORMAT = "JPEG"
+IMAGE_QUALITY = 95
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+def encode_image(image_path, fmt=IMAGE_FORMAT, quality=IMAGE_QUALITY, max_pixels=None):
+    """用 PIL 将图像重新编码并转为base64；指定 max_pixels 时先等比例缩小到像素预算以内"""
+    with Image.open(image_path) as img:
+        img = img.convert("RGB")
+        if max_pixels and img.width * img.height > max_pixels:
+            scale = math.sqrt(max_pixels / (img.width * img.height))
+            size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+            # 与 Qwen2-VL 图像处理器默认的插值方式一致
+            img = img.resize(size, Image.BICUBIC)
+        buffered = BytesIO()
+        img.save(buffered, format=fmt, quality=quality)
+        return base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+class ImagePolicy:
+    """图像的编码与传输方式
+
+    transport 为 base64 时按 fmt / quality 重新编码（指定 max_pixels 时先缩小到
+    与模型一致的像素预算）后以 data URL 发送；file 时发送 file:// 本地路径，
+    由服务端直接读取原图（vLLM 需以 --allowed-local-media-path 启动）；url 时
+    发送 url_prefix 加上样本中的相对路径，由服务端下载。
+    """
+    def __init__(self, fmt=IMAGE_FORMAT, quality=IMAGE_QUALITY, max_pixels=None, transport="base64",
+                 url_prefix=None):
+        if transport == "url" and not url_prefix:
+            raise ValueError("--image_transport url 需要指定 --image_url_prefix")
+        self.fmt = fmt.upper()
+        self.quality = quality
+        self.max_pixels = max_pixels
+        self.transport = transport
+        self.url_prefix = url_prefix
+
+    @property
+    def mime_type(self):
+        return IMAGE_MIME_TYPES.get(self.fmt, f"image/{self.fmt.lower()}")
+
+class ImageCache:
+    """图像编码结果的磁盘缓存
+
+    缓存键由图像绝对路径、文件 mtime/大小以及编码参数（格式、质量、像素
+    预算）共同决定，图像文件被修改或编码参数变化后旧缓存自动失效。
+    """
+    def __init__(self, cache_dir, fmt=IMAGE_FORMAT, quality=IMAGE_QUALITY, max_pixels=None):
+        self.cache_dir = cache_dir
+        self.fmt = fmt
+        self.quality = quality
+        self.max_pixels = max_pixels
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, image_path):
+        st = os.stat(image_path)
+        raw = f"{os.path.abspath(image_path)}|{st.st_mtime_ns}|{st.st_size}|{self.fmt}|{self.quality}"
+        if self.max_pixels:
+            raw += f"|{self.max_pixels}"
+        key = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + ".b64")
+
+    def get(self, image_path):
+        """读取缓存，未命中（包括空条目）返回 None"""
+        try:
+            with open(self._entry_path(image_path), "r") as f:
+                return f.read() or None
+        except OSError:
+            return None
+
+    def put(self, image_path, encoded):
+        """写入缓存
+
+        每次写入用 mkstemp 创建独占的临时文件，写完再原子替换，多进程、多线程
+        同时写入同一条目时互不干扰，读取方只会看到完整的旧条目或新条目。
+        """
+        entry_path = self._entry_path(image_path)
+        entry_dir = os.path.dirname(entry_path)
+        os.makedirs(entry_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=entry_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(encoded)
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def get_or_encode(self, image_path):
+        """命中缓存时直接返回，否则编码后写入缓存"""
+        encoded = self.get(image_path)
+        if encoded is None:
+            encoded = encode_image(image_path, self.fmt, self.quality, self.max_pixels)
+            self.put(image_path, encoded)
+        return encoded
+
+class ResponseCache:
+    """请求级响应缓存（SQLite）
+
+    键为请求体（模型名、消息、采样参数）的 sha256；评测请求是贪心解码，
+    相同请求的输出确定，修改 safe_parse 或指标后重跑无需再访问服务端。
+    mode 为 read 时先查缓存、未命中再请求并写入，refresh 时忽略旧缓存
+    重新请求并覆盖，off 时不使用缓存。缓存总大小超过 max_mb 时按最近
+    访问时间淘汰最旧的条目：每个进程每 evict_interval 秒检查一次，运行
+    结束时由主进程调用 trim 再检查一次。连接在每个进程中惰性建立，可随
+    客户端 pickle。
+    """
+    evict_interval = 5.0
+
+    def __init__(self, path, mode="read", max_mb=2048):
+        self.path = path
+        self.mode = mode
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._conn = None
+        self._lock = threading.Lock()
+        self._next_evict = 0.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_next_evict"] = 0.0
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, content TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+        return self._conn
+
+    @staticmethod
+    def key(payload):
+        """请求体的缓存键"""
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """查询缓存，未命中或 refresh 模式下返回 None"""
+        if self.mode != "read":
+            return None
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, content):
+        """写入缓存，距上次检查超过 evict_interval 秒时检查总大小"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, content, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, content, len(content.encode("utf-8")), time.time())
+            )
+            now = time.monotonic()
+            if now >= self._next_evict:
+                self._next_evict = now + self.evict_interval
+                self._evict(conn)
+
+    def trim(self):
+        """检查总大小并按需淘汰，运行结束时调用"""
+        with self._lock:
+            self._evict(self._connect())
+
+    def _evict(self, conn):
+        """超出大小上限时淘汰最久未访问的条目，直到降到上限的 90%"""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            stale.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+class EndpointPool:
+    """多个 vLLM 服务端点之间的负载均衡
+
+    按最少在途请求数选择端点；请求失败时用与 check_vllm_service.sh 相同的
+    /v1/models 探测确认端点是否存活，探测失败则剔除，冷却 probe_interval
+    秒后再次探测恢复。线程安全，可在 async 引擎的线程池中调用。
+    """
+    def __init__(self, urls, probe_interval=10.0, probe_timeout=5.0):
+        if isinstance(urls, str):
+            urls = [urls]
+        self.urls = [u.rstrip("/") for u in urls]
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.outstanding = {u: 0 for u in self.urls}
+        self.ejected = {}  # url -> 下次探测时间
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def probe(self, url):
+        """探测 /v1/models，返回端点是否可用"""
+        try:
+            return requests.get(f"{url}/v1/models", timeout=self.probe_timeout).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def check_all(self):
+        """探测所有端点，返回可用端点列表"""
+        for url in self.urls:
+            if self.probe(url):
+                self.ejected.pop(url, None)
+            else:
+                self.ejected[url] = time.monotonic() + self.probe_interval
+        return [u for u in self.urls if u not in self.ejected]
+
+    def revive_due(self):
+        """重新探测冷却期已过的被剔除端点"""
+        now = time.monotonic()
+        with self._lock:
+            due = [u for u, t in self.ejected.items() if t <= now]
+            # 先推迟下次探测时间，避免并发调用重复探测
+            for url in due:
+                self.ejected[url] = now + self.probe_interval
+        for url in due:
+            if self.probe(url):
+                with self._lock:
+                    self.ejected.pop(url, None)
+
+    def acquire(self, exclude=None, prefer=None):
+        """选择在途请求最少的可用端点；exclude 仅在存在其他可用端点时生效
+
+        prefer 为调用方（多进程引擎的主进程）已选好的端点，可用时直接使用。
+        """
+        with self._lock:
+            healthy = [u for u in self.urls if u not in self.ejected]
+            if not healthy:
+                return None
+            if exclude is not None and len(healthy) > 1:
+                healthy = [u for u in healthy if u != exclude]
+            if prefer in healthy:
+                url = prefer
+            else:
+                least = min(self.outstanding[u] for u in healthy)
+                url = random.choice([u for u in healthy if self.outstanding[u] == least])
+            self.outstanding[url] += 1
+            return url
+
+    def release(self, url, failed=False):
+        """请求结束；失败时探测端点，不可用则剔除"""
+        with self._lock:
+            self.outstanding[url] -= 1
+            if not failed or url in self.ejected:
+                return
+        if not self.probe(url):
+            with self._lock:
+                self.ejected[url] = time.monotonic() + self.probe_interval
+
+    def eject(self, url):
+        """剔除其他进程探测失败的端点，冷却期后由 revive_due 重新探测"""
+        with self._lock:
+            self.ejected.setdefault(url, time.monotonic() + self.probe_interval)
+
+    def has_alternative(self, url):
+        """除 url 外是否还有可用端点（有则失败后立即改投，不再退避等待）"""
+        with self._lock:
+            return any(u != url and u not in self.ejected for u in self.urls)
+
+def classify_error(error):
+    """把请求异常归类为 overload（429/503 或读超时，服务端过载）、connect（连接失败）或 other"""
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        status = getattr(error, "status", None)  # aiohttp.ClientResponseError
+    if status in (429, 503):
+        return "overload"
+    if isinstance(error, requests.ConnectTimeout):
+        return "connect"
+    if isinstance(error, (requests.Timeout, asyncio.TimeoutError)):
+        return "overload"
+    if isinstance(error, (ConnectionError, requests.ConnectionError)):
+        return "connect"
+    if aiohttp is not None and isinstance(error, aiohttp.ClientConnectionError):
+        return "connect"
+    return "other"
+
+def retry_after_seconds(error):
+    """读取 429/503 响应的 Retry-After 头（秒），没有时返回 None"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+# 各类错误的重试预算（该类错误累计出现多少次后放弃）
+RETRY_BUDGETS = {"connect": 5, "overload": 8, "other": 5}
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# 所有请求共用的系统提示，放在消息最前面，使每个请求的开头字节完全相同，
+# vLLM 的自动前缀缓存可以在所有样本之间复用这部分 KV
+SYSTEM_PROMPT = (
+    "A conversation between User and Assistant. The user asks a question, and the Assistant solves it. "
+    "The assistant first thinks about the reasoning process in the mind and then provides the user with the answer. "
+    "The reasoning process and answer are enclosed within <think> </think> and <answer> </answer> tags."
+)
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# 默认的贪心解码参数
+DEFAULT_SAMPLING = {"temperature": 0.0, "top_p": 1, "repetition_penalty": 1.00}
+
 # ========================
 # 2. 视觉语言消息客户端
 # ========================
 class VLMessageClient:
-    def __init__(self, api_url, model_name):
-        self.api_url = api_url
+    def __init__(self, api_url, model_name, image_cache=None, response_cache=None, request_timeout=100,
+                 retry_budgets=None, sampling=None, n=1, image_policy=None):
+        self.endpoints = api_url if isinstance(api_url, EndpointPool) else EndpointPool(api_url)
         self.model_name = model_name
+        self.sampling = dict(DEFAULT_SAMPLING, **(sampling or {}))
+        self.n = n
+        self.image_policy = image_policy or ImagePolicy()
+        self.image_cache = image_cache
+        self.response_cache = response_cache
+        self.request_timeout = request_timeout
+        self.retry_budgets = dict(RETRY_BUDGETS, **(retry_budgets or {}))
         self.session = requests.Session()
+        self._body_prefix, self._body_suffix = self._split_body_template()
+
+    def _split_body_template(self):
+        """预先序列化请求体中与样本无关的部分，返回 (前缀字节, 后缀字节)
+
+        前缀包含模型名和系统消息，后缀包含采样参数，每个样本只需序列化自己的
+        用户消息再拼接；拼接结果与直接序列化整个请求体逐字节相同。
+        """
+        marker = "__ITEM_MESSAGE__"
+        template = json.dumps(self._payload_for(marker), ensure_ascii=False)
+        prefix, suffix = template.split(json.dumps(marker))
+        return prefix.encode("utf-8"), suffix.encode("utf-8")
 
     def _encode_image(self, image_path):
-        """编码图像为base64"""
-        with Image.open(image_path) as img:
-            img = img.convert("RGB")
-            buffered = BytesIO()
-            img.save(buffered, format="JPEG", quality=95)
-            return base64.b64encode(buffered.getvalue()).decode("utf-8")
+        """编码图像为base64（配置了缓存时优先读取缓存）"""
+        if self.image_cache is not None:
+            return self.image_cache.get_or_encode(image_path)
+        policy = self.image_policy
+        return encode_image(image_path, policy.fmt, policy.quality, policy.max_pixels)
+
+    def image_url(self, item, image_root):
+        """按图像传输策略生成消息中的 image_url"""
+        policy = self.image_policy
+        if policy.transport == "url":
+            return f"{policy.url_prefix.rstrip('/')}/{item['image_path'].lstrip('./')}"
+        image_path = resolve_image_path(item, image_root)
+        if policy.transport == "file":
+            return f"file://{os.path.abspath(image_path)}"
+        return f"data:{policy.mime_type};base64,{self._encode_image(image_path)}"
+
+    def build_user_message(self, item, image_root):
+        """构建样本的用户消息（图像在前、问题在后）"""
+        return {
+            "role": "user",
+            "content": [
+                {"type": "image_url", "image_url": {"url": self.image_url(item, image_root)}},
+                {
+                    "type": "text",
+                    "text": f"{item['question']}"
+                }
+            ]
+        }
 
     def build_messages(self, item, image_root):
-        """构建消息"""
-        # 1. 获取图像路径
-        image_path = os.path.join(image_root, item['image_path'].lstrip('./'))
-
-        # 2. 构建消息（按照要求修改）
-        return [
-            {
-                "role": "system",
-                "content": (
-                    "A conversation between User and Assistant. The user asks a question, and the Assistant solves it. "
-                    "The assistant first thinks about the reasoning process in the mind and then provides the user with the answer. "
-                    "The reasoning process and answer are enclosed within <think> </think> and <answer> </answer> tags."
-                )
-            },
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{self._encode_image(image_path)}"}},
-                    {
-                        "type": "text",
-                        "text": f"{item['question']}"
-                    }
-                ]
-            }
-        ]
+        """构建消息：共用的系统消息 + 样本的用户消息"""
+        return [SYSTEM_MESSAGE, self.build_user_message(item, image_root)]
+
+    def _payload_for(self, user_message):
+        payload = {
+            "model": self.model_name,
+            "messages": [SYSTEM_MESSAGE, user_message],
+            **self.sampling
+        }
+        if self.n > 1:
+            payload["n"] = self.n
+        return payload
+
+    def build_payload(self, item, image_root):
+        """构建请求体；n 大于 1 时由服务端一次返回 n 个采样结果"""
+        return self._payload_for(self.build_user_message(item, image_root))
+
+    def parse_outputs(self, data):
+        """从响应中取出模型输出：n 为 1 时返回字符串，否则返回按 index 排序的列表"""
+        choices = sorted(data["choices"], key=lambda c: c.get("index", 0))
+        outputs = [c["message"]["content"] for c in choices]
+        return outputs[0] if self.n == 1 else outputs
+
+    def prepare_request(self, item, image_root):
+        """构建并序列化请求体，查询响应缓存，返回 (请求体字节, 缓存键, 缓存的输出)
+
+        请求体只序列化一次，重试时直接复用，其长度即每个请求发送的字节数。
+        与样本无关的前缀和后缀已预先序列化，这里只序列化用户消息。
+        """
+        user_message = self.build_user_message(item, image_root)
+        body = self._body_prefix + json.dumps(user_message, ensure_ascii=False).encode("utf-8") + self._body_suffix
+        if self.response_cache is None:
+            return body, None, None
+        cache_key = self.response_cache.key(self._payload_for(user_message))
+        cached = self.response_cache.get(cache_key)
+        if cached is not None and self.n > 1:
+            cached = json.loads(cached)
+        return body, cache_key, cached
+
+    def cache_output(self, cache_key, output):
+        """把模型输出写入响应缓存（多个采样结果存为 JSON 列表）
+
+        写入失败（例如 SQLite 被锁）只打印警告：请求已经成功，不应因此重试。
+        """
+        content = output if isinstance(output, str) else json.dumps(output, ensure_ascii=False)
+        try:
+            self.response_cache.put(cache_key, content)
+        except Exception as e:
+            print(f"警告: 写入响应缓存失败: {e}")
+
+    @staticmethod
+    def build_timing(start, queue_wait, encode_time, http_latency, attempt, failures=None):
+        """单个样本的耗时记录（秒）：排队等待、图像编码、成功那次请求的 HTTP 延迟、总耗时、
+        重试次数以及各类失败的次数"""
+        return {
+            "queue_wait": round(queue_wait, 4) if queue_wait is not None else None,
+            "encode": round(encode_time, 4) if encode_time is not None else None,
+            "http_latency": round(http_latency, 4) if http_latency is not None else None,
+            "total": round(time.time() - start, 4),
+            "retries": max(int(attempt) - 1, 0),
+            "failures": dict(failures) if failures else None
+        }
+
+    def retry_delay(self, kind, count, error, url):
+        """失败后重试前的等待秒数
+
+        服务端过载时总是退避（即使改投其他端点，其他副本很可能同样过载）：
+        优先遵循 Retry-After，否则按带随机抖动的指数退避等待（都最长 30 秒），
+        避免重试进一步加重负载。连接失败和其他错误说明端点本身有问题，
+        还有其他可用端点时立即改投，否则按原来的指数退避（最长 10 秒）。
+        """
+        if kind == "overload":
+            retry_after = retry_after_seconds(error)
+            if retry_after is not None:
+                return min(max(retry_after, 0), 30)
+            return min(2 ** count, 30) * random.uniform(0.5, 1.0)
+        if url is not None and self.endpoints.has_alternative(url):
+            return 0
+        return min(2 ** count, 10)
 
-    def process_item(self, item, image_root, output_file, error_file, total_counter, correct_counter, lock):
-        """处理单个项目"""
-        max_retries = 5
-        attempt = 0
-        result = None
+    def build_result(self, item, output, attempt, from_cache=False, timing=None, usage=None, request_bytes=None):
+        """根据模型输出构建成功结果（current_* 字段由 ResultWriter 写入时填充）
 
-        while attempt < max_retries:
+        output 为多个采样结果的列表时，model_output / is_correct 对应第一个
+        结果，全部结果及其正确数记录在 model_outputs / num_correct 中。
+        """
+        outputs = output if isinstance(output, list) else [output]
+        # 解析和验证答案
+        scored = [score_output(o, item["ground_truth"]) for o in outputs]
+        pred, is_correct = scored[0]
+        output = outputs[0]
+
+        record = {
+            "item_id": str(item["item_id"]),
+            "question": str(item["question"]),
+            "image_path": str(item["image_path"]),
+            "model_output": str(output),
+            "extracted_answer": str(pred[0]) if pred else None,
+            "ground_truth": str(item["ground_truth"]),
+            "is_correct": bool(is_correct),
+            "current_correct": None,
+            "current_total": None,
+            "current_accuracy": None,
+            "attempt": int(attempt),
+            "success": bool(True),
+            "from_cache": bool(from_cache),
+            "model": self.model_name,
+            "timing": timing,
+            "usage": usage,
+            "request_bytes": request_bytes
+        }
+        if len(outputs) > 1:
+            record["n"] = len(outputs)
+            record["num_correct"] = sum(int(c) for _, c in scored)
+            record["model_outputs"] = [str(o) for o in outputs]
+            record["extracted_answers"] = [str(p[0]) if p else None for p, _ in scored]
+        return record
+
+    def build_error(self, item, error, attempt, timing=None, request_bytes=None):
+        """构建失败结果"""
+        return {
+            "item_id": str(item["item_id"]),
+            "question": str(item["question"]),
+            "image_path": str(item["image_path"]),
+            "error": str(error),
+            "attempt": int(attempt),
+            "success": bool(False),
+            "timing": timing,
+            "request_bytes": request_bytes
+        }
+
+    def process_item(self, item, image_root, submitted_at=None, endpoint=None):
+        """处理单个项目，返回成功或失败结果记录，由主进程统一写入
+
+        submitted_at 为样本提交到引擎的时间戳（time.time()），用于计算排队等待时间。
+        endpoint 为主进程按全局在途请求数选好的端点，第一次请求优先使用。
+        连接失败、服务端过载和其他错误分别计入各自的重试预算（retry_budgets），
+        计数、预算和退避由 RequestAttempts 完成。
+        """
+        state = RequestAttempts(self, item, submitted_at)
+        while True:
+            url = None
             try:
-                attempt += 1
-                messages = self.build_messages(item, image_root)
-
-                payload = {
-                    "model": self.model_name,
-                    "messages": messages,
-                    "temperature": 0.0,
-                    "top_p": 1,
-                    "repetition_penalty": 1.00
-                }
+                state.attempt += 1
+                # 请求体只构建一次，重试时不再重复编码图像
+                if state.body is None:
+                    t0 = time.perf_counter()
+                    prepared = self.prepare_request(item, image_root)
+                    cached_record = state.prepared(*prepared, time.perf_counter() - t0)
+                    if cached_record is not None:
+                        return cached_record
 
+                self.endpoints.revive_due()
+                url = self.endpoints.acquire(exclude=state.failed_url, prefer=endpoint if state.attempt == 1 else None)
+                if url is None:
+                    raise ConnectionError("没有可用的服务端点")
+
+                t0 = time.perf_counter()
                 response = self.session.post(
-                    f"{self.api_url}/v1/chat/completions",
-                    json=payload,
-                    timeout=100 + attempt * 5
+                    f"{url}/v1/chat/completions",
+                    data=state.body,
+                    headers=JSON_HEADERS,
+                    timeout=self.request_timeout + state.attempt * 5
                 )
                 response.raise_for_status()
+                data = response.json()
+                http_latency = time.perf_counter() - t0
 
-                output = response.json()["choices"][0]["message"]["content"]
-
-                # 解析和验证答案
-                gt = safe_parse(item["ground_truth"])
-                pred = safe_parse(output)
-                is_correct = bool(pred and gt and safe_verify(pred, gt))
-
-                with lock:
-                    total_counter.value += 1
-                    correct_counter.value += int(is_correct)
-                    current_accuracy = float(correct_counter.value) / float(total_counter.value) if total_counter.value > 0 else 0.0
-
-                # 构建成功结果
-                result = {
-                    "question": str(item["question"]),
-                    "image_path": str(item["image_path"]),
-                    "model_output": str(output),
-                    "extracted_answer": str(pred[0]) if pred else None,
-                    "ground_truth": str(item["ground_truth"]),
-                    "is_correct": bool(is_correct),
-                    "current_correct": int(correct_counter.value),
-                    "current_total": int(total_counter.value),
-                    "current_accuracy": float(current_accuracy),
-                    "attempt": int(attempt),
-                    "success": bool(True),
-                    "model": self.model_name
-                }
+                output = self.parse_outputs(data)
+                self.endpoints.release(url)
+                url = None  # 已释放，之后的异常不能再次释放
+                if state.cache_key is not None:
+                    self.cache_output(state.cache_key, output)
+                return state.succeeded(output, data, http_latency)
 
-                # 写入成功文件
-                with lock:
-                    try:
-                        with open(output_file, "a") as f:
-                            json.dump(result, f, ensure_ascii=False, default=str)
-                            f.write("\n")
-                            f.flush()
-                    except Exception as e:
-                        print(f"写入成功文件失败: {str(e)}")
+            except Exception as e:
+                kind = state.count_failure(e)
+                if url is not None:
+                    # 过载说明端点仍然存活，不必探测
+                    self.endpoints.release(url, failed=kind != "overload")
+                error_record, delay = state.retry_or_give_up(kind, e, url)
+                if error_record is not None:
+                    return error_record
+                if delay:
+                    time.sleep(delay)
 
-                return True
+    async def process_item_async(self, session, item, image_root, submitted_at=None, limiter=None):
+        """异步处理单个项目，返回值与 process_item 相同
+
+        重试记账与 process_item 共用 RequestAttempts；图像编码放到线程池中执行，
+        避免阻塞事件循环。指定 limiter（AdaptiveConcurrency）时每次 HTTP 请求
+        都要先取得名额，并把延迟或过载反馈给它。
+        """
+        loop = asyncio.get_running_loop()
+        state = RequestAttempts(self, item, submitted_at)
+        while True:
+            url = None
+            try:
+                state.attempt += 1
+                if state.body is None:
+                    t0 = time.perf_counter()
+                    prepared = await loop.run_in_executor(None, self.prepare_request, item, image_root)
+                    cached_record = state.prepared(*prepared, time.perf_counter() - t0)
+                    if cached_record is not None:
+                        return cached_record
+
+                if self.endpoints.ejected:
+                    await loop.run_in_executor(None, self.endpoints.revive_due)
+                url = self.endpoints.acquire(exclude=state.failed_url)
+                if url is None:
+                    raise ConnectionError("没有可用的服务端点")
+
+                started = await limiter.acquire() if limiter is not None else None
+                t0 = time.perf_counter()
+                try:
+                    async with session.post(
+                        f"{url}/v1/chat/completions",
+                        data=state.body,
+                        headers=JSON_HEADERS,
+                        timeout=aiohttp.ClientTimeout(total=self.request_timeout + state.attempt * 5)
+                    ) as response:
+                        response.raise_for_status()
+                        data = await response.json()
+                except Exception as e:
+                    if limiter is not None:
+                        await limiter.release(started, overloaded=classify_error(e) == "overload")
+                    raise
+                http_latency = time.perf_counter() - t0
+                if limiter is not None:
+                    await limiter.release(started, latency=http_latency)
+
+                output = self.parse_outputs(data)
+                self.endpoints.release(url)
+                url = None  # 已释放，之后的异常不能再次释放
+                if state.cache_key is not None:
+                    await loop.run_in_executor(None, self.cache_output, state.cache_key, output)
+                return state.succeeded(output, data, http_latency)
 
             except Exception as e:
-                if attempt == max_retries:
-                    # 构建失败结果
-                    error_data = {
-                        "question": str(item["question"]),
-                        "image_path": str(item["image_path"]),
-                        "error": str(e),
-                        "attempt": int(attempt),
-                        "success": bool(False)
-                    }
-                    # 写入错误文件
-                    with lock:
-                        try:
-                            with open(error_file, "a") as f:
-                                json.dump(error_data, f, ensure_ascii=False, default=str)
-                                f.write("\n")
-                                f.flush()
-                        except Exception as e:
-                            print(f"写入错误文件失败: {str(e)}")
-                    return False
-                else:
-                    time.sleep(min(2 ** attempt, 10))
-
-        return False
+                kind = state.count_failure(e)
+                if url is not None:
+                    await loop.run_in_executor(None, self.endpoints.release, url, kind != "overload")
+                error_record, delay = state.retry_or_give_up(kind, e, url)
+                if error_record is not None:
+                    return error_record
+                if delay:
+                    await asyncio.sleep(delay)
+
+class RequestAttempts:
+    """单个样本在多次请求之间的状态与重试记账
+
+    process_item 和 process_item_async 只负责发送请求、释放端点和等待，
+    失败分类计数、重试预算判断、退避时间以及结果记录的构建都在这里完成，
+    两个引擎的重试行为因此始终一致。
+    """
+    def __init__(self, client, item, submitted_at=None):
+        self.client = client
+        self.item = item
+        self.attempt = 0
+        self.failures = {"connect": 0, "overload": 0, "other": 0}
+        self.body = None
+        self.cache_key = None
+        self.failed_url = None
+        self.start = time.time()
+        self.queue_wait = self.start - submitted_at if submitted_at is not None else None
+        self.encode_time = None
+
+    def timing(self, http_latency=None, attempt=None):
+        attempt = self.attempt if attempt is None else attempt
+        return self.client.build_timing(self.start, self.queue_wait, self.encode_time, http_latency, attempt,
+                                        self.failures if attempt else None)
+
+    def prepared(self, body, cache_key, cached, encode_time):
+        """记录 prepare_request 的结果；命中响应缓存时返回缓存结果记录，否则返回 None"""
+        self.body, self.cache_key, self.encode_time = body, cache_key, encode_time
+        if cached is None:
+            return None
+        return self.client.build_result(self.item, cached, 0, from_cache=True, timing=self.timing(attempt=0))
+
+    def succeeded(self, output, data, http_latency):
+        """请求成功时的结果记录"""
+        return self.client.build_result(self.item, output, self.attempt, timing=self.timing(http_latency),
+                                        usage=data.get("usage"), request_bytes=len(self.body))
+
+    def count_failure(self, error):
+        """把一次失败计入对应类型，返回失败类型（调用方据此释放端点）"""
+        kind = classify_error(error)
+        self.failures[kind] += 1
+        return kind
+
+    def retry_or_give_up(self, kind, error, url):
+        """返回 (失败结果记录, 重试前等待秒数)：该类错误的预算用完时返回失败记录
+
+        url 为本次请求占用的端点（调用方已释放），下一次请求避开它。
+        """
+        if self.failures[kind] >= self.client.retry_budgets[kind]:
+            request_bytes = len(self.body) if self.body is not None else None
+            return self.client.build_error(self.item, error, self.attempt, self.timing(), request_bytes), 0
+        self.failed_url = url
+        return None, self.client.retry_delay(kind, self.failures[kind], error, url)
 
 # ========================
-# 3. 主函数
+# 3. 结果写入与断点续跑
 # ========================
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--api_url", default="http://127.0.0.1:8000")
-    parser.add_argument("--model_name", required=True, help="模型名称")
-    parser.add_argument("--prompt_path", required=True, help="测试集路径")
-    parser.add_argument("--image_root", default="../", help="图像根目录")
-    parser.add_argument("--output_path", required=True, help="输出文件路径")
-    parser.add_argument("--max_workers", type=int, default=3, help="最大工作进程数")
-    args = parser.parse_args()
+def record_key(record):
+    """断点续跑、错误追踪和最终统计使用的样本键
 
-    # 设置错误文件路径
-    error_output_path = os.path.splitext(args.output_path)[0] + "_errors.jsonl"
+    旧版本输出中没有 item_id 的成功记录按同样的规则从记录内容计算。
+    """
+    item_id = record.get("item_id")
+    if item_id is None and "ground_truth" in record:
+        item_id = compute_item_id(record)
+    return item_id
 
-    # 1. 加载测试数据
-    test_data_all = pd.read_json(args.prompt_path, lines=True).to_dict("records")
-    total_samples = len(test_data_all)
-    print(f"测试集总数: {total_samples}")
-    print(f"使用模型: {args.model_name}")
+def index_path_for(output_file):
+    """输出文件对应的续跑索引文件路径"""
+    return os.path.splitext(output_file)[0] + "_index.tsv"
 
-    # 2. 恢复已成功处理的数据（只恢复success为true的记录）
-    processed_success = set()  # 成功处理的数据
-    recovered_total = 0
-    recovered_correct = 0
-    valid_records = []  # 有效的成功记录
+def recover_results(output_file, index_file):
+    """从续跑索引恢复已完成的样本，返回 (已完成键集合, 成功数, 正确数)
 
-    # 检查输出文件是否存在
-    output_file_exists = os.path.exists(args.output_path)
+    索引每行为 "键\t记录起始字节偏移\t是否正确"，由 ResultWriter 在输出
+    文件刷盘后追加，因此只需从最后一条已索引记录之后扫描新增的输出并补进
+    索引，开销与新增记录数成正比。输出文件从不重写，唯一的修复是截掉
+    写了一半的最后一行。没有索引（旧版本的输出）时全量扫描一次建立索引。
+    末尾已索引的记录逐条校验（以换行结尾、能解析且键一致），不通过的从索引
+    中去掉，由尾部扫描截断或重新收录。
+    """
+    if not os.path.exists(output_file):
+        open(output_file, "wb").close()
+        open(index_file, "wb").close()
+        return set(), 0, 0
 
-    # 恢复成功记录并清理输出文件
-    if output_file_exists:
-        print("检查输出文件...")
-        with open(args.output_path, "r") as f:
+    keys = set()
+    total = correct = 0
+    last_offset = None
+    index_valid_size = 0
+    entries = []  # 已读入的索引行 (键, 偏移, 是否正确, 行字节数)
+    if os.path.exists(index_file):
+        with open(index_file, "rb") as f:
             for line in f:
+                if not line.endswith(b"\n"):
+                    break  # 索引最后一行写了一半
                 try:
-                    data = json.loads(line)
-                    if data.get("success", False):
-                        processed_success.add(data["image_path"])
-                        recovered_total += 1
-                        if data.get("is_correct", False):
-                            recovered_correct += 1
-                        valid_records.append(data)
-                except json.JSONDecodeError:
-                    continue
+                    key, offset, is_correct = line.decode("utf-8").rstrip("\n").split("\t")
+                    offset = int(offset)
+                except ValueError:
+                    break
+                keys.add(key)
+                total += 1
+                correct += int(is_correct)
+                last_offset = offset
+                index_valid_size += len(line)
+                entries.append((key, offset, int(is_correct), len(line)))
+
+    if last_offset is not None and last_offset >= os.path.getsize(output_file):
+        # 索引与输出文件不匹配（输出被替换或截短），重建索引
+        print("续跑索引与输出文件不一致，重新建立索引")
+        keys, total, correct, last_offset, index_valid_size = set(), 0, 0, None, 0
+        entries = []
+
+    def indexed_record_intact(f, key, offset):
+        f.seek(offset)
+        line = f.readline()
+        if not line.endswith(b"\n"):
+            return False
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return False
+        return isinstance(data, dict) and record_key(data) == key
+
+    with open(output_file, "rb") as f:
+        while entries and not indexed_record_intact(f, entries[-1][0], entries[-1][1]):
+            # 输出末尾被截短或写坏，已索引的记录不完整：去掉索引项，交给尾部扫描处理
+            key, offset, is_correct, length = entries.pop()
+            print(f"续跑索引中的记录不完整，重新扫描 (偏移 {offset})")
+            keys.discard(key)
+            total -= 1
+            correct -= is_correct
+            index_valid_size -= length
+            last_offset = entries[-1][1] if entries else None
+    del entries
+
+    new_entries = []
+    with open(output_file, "r+b") as f:
+        # 定位到最后一条已索引记录的末尾
+        if last_offset is not None:
+            f.seek(last_offset)
+            f.readline()
+        tail_start = f.tell()
+        while True:
+            line_start = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            try:
+                data = json.loads(line)
+            except ValueError:
+                data = None
+            if not line.endswith(b"\n"):
+                if data is None:
+                    # 中断时写了一半的最后一行，截断
+                    print(f"截断输出文件末尾不完整的记录 (偏移 {line_start})")
+                    f.truncate(line_start)
+                    break
+                # 完整记录只是缺少换行符，补上
+                f.write(b"\n")
+            if isinstance(data, dict) and data.get("success", False):
+                key = record_key(data)
+                is_correct = bool(data.get("is_correct", False))
+                keys.add(key)
+                total += 1
+                correct += int(is_correct)
+                new_entries.append(f"{key}\t{line_start}\t{int(is_correct)}\n")
+
+    with open(index_file, "r+b" if os.path.exists(index_file) else "wb") as f:
+        f.truncate(index_valid_size)
+        f.seek(index_valid_size)
+        f.write("".join(new_entries).encode("utf-8"))
+
+    if new_entries:
+        print(f"续跑索引补充 {len(new_entries)} 条记录 (从偏移 {tail_start} 开始扫描)")
+    return keys, total, correct
 
-        # 重写输出文件，只保留成功记录
-        if valid_records:
-            print(f"找到 {len(valid_records)} 条成功记录")
-            with open(args.output_path, "w") as f:
-                for record in valid_records:
-                    json.dump(record, f, ensure_ascii=False, default=str)
-                    f.write("\n")
+def _percentile(sorted_values, q):
+    """已排序列表的百分位数（最近秩法），空列表返回 None"""
+    if not sorted_values:
+        return None
+    rank = max(int(round(q / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+class RunMetrics:
+    """本次运行的吞吐与延迟统计
+
+    由 ResultWriter 在主进程中对每条结果调用 observe，汇总记录中的 timing
+    和 usage 字段；maybe_report 每隔 report_interval 秒返回一行摘要（请求/s、
+    tokens/s、p50/p95/p99 延迟），summary 返回写入 _stats.json 的汇总。
+    只统计本次运行处理的样本，不包括断点续跑恢复的记录。
+    """
+    def __init__(self, report_interval=30.0):
+        self.report_interval = report_interval
+        self.start = time.monotonic()
+        self.requests = 0
+        self.failed = 0
+        self.cache_hits = 0
+        self.retries = 0
+        self.overloads = 0
+        self.request_bytes = 0
+        self.sent_requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies = []
+        self.encode_times = []
+        self.queue_waits = []
+        self._last_report = self.start
+        self._last_requests = 0
+        self._last_tokens = 0
+
+    def observe(self, record):
+        self.requests += 1
+        if not record.get("success", False):
+            self.failed += 1
+        if record.get("from_cache"):
+            self.cache_hits += 1
+        timing = record.get("timing") or {}
+        self.retries += timing.get("retries") or 0
+        self.overloads += (timing.get("failures") or {}).get("overload", 0)
+        if timing.get("http_latency") is not None:
+            self.latencies.append(timing["http_latency"])
+        if timing.get("encode") is not None:
+            self.encode_times.append(timing["encode"])
+        if timing.get("queue_wait") is not None:
+            self.queue_waits.append(timing["queue_wait"])
+        if record.get("request_bytes") is not None and not record.get("from_cache"):
+            self.request_bytes += record["request_bytes"]
+            self.sent_requests += 1
+        usage = record.get("usage") or {}
+        self.prompt_tokens += usage.get("prompt_tokens") or 0
+        self.completion_tokens += usage.get("completion_tokens") or 0
+
+    def maybe_report(self):
+        """距上次摘要超过 report_interval 秒时返回摘要字符串，否则返回 None"""
+        now = time.monotonic()
+        if self.report_interval <= 0 or now - self._last_report < self.report_interval:
+            return None
+        window = now - self._last_report
+        recent_rps = (self.requests - self._last_requests) / window
+        recent_tps = (self.completion_tokens - self._last_tokens) / window
+        self._last_report, self._last_requests, self._last_tokens = now, self.requests, self.completion_tokens
+
+        latencies = sorted(self.latencies)
+        fmt = lambda v: f"{v:.2f}s" if v is not None else "N/A"
+        return (
+            f"[吞吐] 请求 {self.requests} ({recent_rps:.2f}/s) | "
+            f"生成 tokens {recent_tps:.1f}/s | "
+            f"延迟 p50 {fmt(_percentile(latencies, 50))} p95 {fmt(_percentile(latencies, 95))} "
+            f"p99 {fmt(_percentile(latencies, 99))} | "
+            f"请求体 {self.request_bytes / max(self.sent_requests, 1) / 1024:.1f} KB | "
+            f"重试 {self.retries} (过载 {self.overloads}) | 失败 {self.failed} | 缓存命中 {self.cache_hits}"
+        )
+
+    def summary(self):
+        """汇总统计，写入 _stats.json"""
+        elapsed = time.monotonic() - self.start
+
+        def dist(values):
+            values = sorted(values)
+            return {
+                "mean": round(sum(values) / len(values), 4) if values else None,
+                "p50": _percentile(values, 50),
+                "p95": _percentile(values, 95),
+                "p99": _percentile(values, 99),
+                "max": values[-1] if values else None
+            }
+
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "requests": self.requests,
+            "failed": self.failed,
+            "cache_hits": self.cache_hits,
+            "retries": self.retries,
+            "overloads": self.overloads,
+            "request_bytes_mean": round(self.request_bytes / self.sent_requests) if self.sent_requests else None,
+            "requests_per_second": round(self.requests / elapsed, 4) if elapsed > 0 else None,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "completion_tokens_per_second": round(self.completion_tokens / elapsed, 2) if elapsed > 0 else None,
+            "http_latency": dist(self.latencies),
+            "encode": dist(self.encode_times),
+            "queue_wait": dist(self.queue_waits)
+        }
+
+class ResultWriter:
+    """唯一的结果写入方
+
+    独占成功/错误 JSONL 文件句柄并维护运行中的正确数与总数。工作进程
+    （或协程）只返回结果记录，所有写入都在主进程中完成，热路径上没有
+    跨进程锁；每 flush_every 条或 flush_interval 秒批量刷盘一次。
+    成功记录的字节偏移在输出文件刷盘后追加到续跑索引，每条结果同时计入
+    metrics 的吞吐与延迟统计；指定 stats 时按其节奏增量更新统计文件。
+    """
+    def __init__(self, output_file, error_file, total=0, correct=0, flush_every=50, flush_interval=2.0,
+                 metrics=None, stats=None):
+        self.total = total
+        self.correct = correct
+        self.recovered = total
+        self.failed = 0
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.stats = stats
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._out_f = open(output_file, "ab")
+        self._err_f = open(error_file, "ab")
+        self._idx_f = open(index_path_for(output_file), "ab")
+        self._offset = self._out_f.tell()
+        self._index_entries = []
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, record):
+        """写入一条结果记录，成功记录会填充当前累计统计"""
+        self.metrics.observe(record)
+        line = None
+        if record.get("success", False):
+            self.total += 1
+            self.correct += int(record["is_correct"])
+            record["current_correct"] = self.correct
+            record["current_total"] = self.total
+            record["current_accuracy"] = float(self.correct) / float(self.total)
+            line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+            self._out_f.write(line)
+            self._index_entries.append(f"{record_key(record)}\t{self._offset}\t{int(record['is_correct'])}\n")
+            self._offset += len(line)
         else:
-            print("输出文件中没有有效记录，创建空文件")
-            open(args.output_path, 'w').close()
-    else:
-        # 创建输出文件
-        print("输出文件不存在，创建新文件")
-        open(args.output_path, 'w').close()
+            self.failed += 1
+            self._err_f.write((json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8"))
 
-    # 安全打印恢复统计信息
-    print(f"已成功恢复记录数: {recovered_total} ({recovered_total/total_samples:.2%})")
-    if recovered_total > 0:
-        print(f"已恢复正确记录数: {recovered_correct} ({recovered_correct/recovered_total:.2%})")
-    else:
-        print(f"已恢复正确记录数: 0 (N/A)")
+        self._pending += 1
+        if self._pending >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+        if self.stats is not None:
+            self.stats.maybe_write(self)
+
+    def flush(self):
+        self._out_f.flush()
+        self._err_f.flush()
+        # 索引只指向已经刷盘的记录
+        if self._index_entries:
+            self._idx_f.write("".join(self._index_entries).encode("utf-8"))
+            self._idx_f.flush()
+            self._index_entries = []
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def postfix(self, total_samples):
+        """进度条显示的统计信息"""
+        return {
+            "当前正确": self.correct,
+            "当前总数": self.total,
+            "准确率": f"{self.correct/self.total:.2%}" if self.total > 0 else "N/A",
+            "已处理": f"{self.total}/{total_samples}"
+        }
+
+    def close(self):
+        self.flush()
+        self._out_f.close()
+        self._err_f.close()
+        self._idx_f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def write_json_atomic(path, obj):
+    """先写临时文件再原子替换，读取方不会读到写了一半的文件"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=4)
+    os.replace(tmp_path, path)
 
-    # 3. 确定剩余待处理数据（所有未成功的数据）
-    remaining_data = []
-    for item in test_data_all:
-        img_path = item["image_path"]
-        if img_path not in processed_success:
-            remaining_data.append(item)
+class StatsWriter:
+    """运行过程中增量维护 _stats.json
 
-    print(f"剩余待处理记录数: {len(remaining_data)}")
+    计数直接取自 ResultWriter 的累计值（续跑恢复的记录 + 本次运行的结果），
+    每 every 条结果或 interval 秒原子地重写一次统计文件，包含成功/失败/正确数、
+    准确率、本次运行的吞吐和预计剩余时间；监控脚本只需读取这一个文件。
+    结束时由 write 写入 status 为 finished 的最终统计，不再重新扫描结果文件。
+    """
+    def __init__(self, path, info, total_samples, num_pending, every=100, interval=5.0):
+        self.path = path
+        self.info = info
+        self.total_samples = total_samples
+        self.num_pending = num_pending
+        self.every = every
+        self.interval = interval
+        self.start = time.monotonic()
+        self._since_write = 0
+        self._last_write = self.start
 
-    # 4. 处理剩余数据
-    if remaining_data:
+    def maybe_write(self, writer):
+        self._since_write += 1
+        if self._since_write >= self.every or time.monotonic() - self._last_write >= self.interval:
+            self.write(writer)
+
+    def write(self, writer, status="running", performance=None, counts=None):
+        """刷盘结果文件后重写统计文件，保证统计不会超前于已落盘的结果
+
+        counts 为 (成功数, 失败数, 正确数)，默认取 writer 的累计值
+        """
+        writer.flush()
+        success_count, error_count, correct_count = counts or (writer.total, writer.failed, writer.correct)
+        now = time.monotonic()
+        elapsed = now - self.start
+        processed = writer.total - writer.recovered + writer.failed
+        remaining = max(self.num_pending - processed, 0)
+        rate = processed / elapsed if elapsed > 0 else 0
+        write_json_atomic(self.path, {
+            "total_samples": self.total_samples,
+            **self.info,
+            "successful_inferences": success_count,
+            "failed_inferences": error_count,
+            "correct_results": correct_count,
+            "accuracy": correct_count / success_count if success_count > 0 else 0,
+            "status": status,
+            "progress": {
+                "processed": processed,
+                "remaining": remaining,
+                "elapsed_seconds": round(elapsed, 3),
+                "items_per_second": round(rate, 4),
+                "eta_seconds": round(remaining / rate, 1) if rate > 0 else None,
+                "updated_at": time.strftime("%Y-%m-%d %H:%M:%S")
+            },
+            "performance": performance
+        })
+        self._since_write = 0
+        self._last_write = now
+
+# ========================
+# 4. 推理引擎
+# ========================
+class AdaptiveConcurrency:
+    """AIMD 自适应并发控制
+
+    根据请求结果调整允许的在途请求数 limit：请求成功且延迟不超过
+    target_latency 时加性增加（开始阶段每次成功加 1，相当于每个往返翻倍；
+    第一次降低后每次加 1/limit），遇到 429/503、超时或延迟超过 target_latency
+    时乘性降低为 limit * decrease_factor。只对上次降低之后发出的请求作出反应，
+    同一次拥塞只降低一次；在途请求数没有达到 limit 时不再增加。limit 不超过
+    引擎的最大并发数（--max_workers / --concurrency），也不低于 min_limit。
+
+    async 引擎对每次 HTTP 请求调用 acquire/release，退避等待中的重试不占用
+    名额；多进程引擎的工作进程阻塞执行整个样本，主进程按样本调用 start/finish。
+    只在主进程（事件循环所在线程）中使用，不需要加锁。
+    """
+    def __init__(self, max_limit, min_limit=1, initial=None, target_latency=None, decrease_factor=0.7):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(initial or min(max(4, self.min_limit), max_limit))
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.slow_start = True
+        self.last_decrease = float("-inf")
+        self.decreases = 0
+        self.peak = self.limit
+        self._condition = None
+
+    def has_capacity(self):
+        return self.in_flight < int(self.limit)
+
+    def observe(self, started, overloaded=False, latency=None):
+        """根据一次请求的结果调整 limit；started 为请求发出时间"""
+        slow = self.target_latency is not None and latency is not None and latency > self.target_latency
+        if overloaded or slow:
+            if started >= self.last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self.last_decrease = time.monotonic()
+                self.slow_start = False
+                self.decreases += 1
+        elif latency is not None and self.in_flight + 1 >= int(self.limit):
+            self.limit = min(self.max_limit, self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+            self.peak = max(self.peak, self.limit)
+
+    def start(self):
+        """发出一个样本，返回发出时间，结束时传给 finish"""
+        self.in_flight += 1
+        return time.monotonic()
+
+    def finish(self, started, record):
+        """样本处理结束，根据结果记录调整 limit；record 为 None 表示处理异常"""
+        self.in_flight -= 1
+        if record is None:
+            return
+        timing = record.get("timing") or {}
+        overloaded = (timing.get("failures") or {}).get("overload", 0) > 0
+        self.observe(started, overloaded, timing.get("http_latency"))
+
+    async def acquire(self):
+        """等待名额后发出一次 HTTP 请求，返回发出时间"""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(self.has_capacity)
+            return self.start()
+
+    async def release(self, started, overloaded=False, latency=None):
+        """一次 HTTP 请求结束，调整 limit 并唤醒等待名额的协程"""
+        self.in_flight -= 1
+        self.observe(started, overloaded, latency)
+        async with self._condition:
+            self._condition.notify_all()
+
+    def summary(self):
+        return {
+            "final_limit": round(self.limit, 2),
+            "peak_limit": round(self.peak, 2),
+            "max_limit": self.max_limit,
+            "decreases": self.decreases,
+            "target_latency": self.target_latency
+        }
+
+def _progress(pbar, writer, total_samples, limiter):
+    """更新进度条，并按间隔打印吞吐摘要"""
+    pbar.update(1)
+    postfix = writer.postfix(total_samples)
+    if limiter is not None:
+        postfix["并发"] = int(limiter.limit)
+    pbar.set_postfix(postfix)
+    report = writer.metrics.maybe_report()
+    if report:
+        pbar.write(report)
+
+_worker_client = None
+
+def _init_worker(client):
+    """工作进程初始化：每个进程只反序列化一次客户端
+
+    端点池状态、响应缓存连接和写入计数在该进程处理的所有样本之间保留。
+    """
+    global _worker_client
+    _worker_client = client
+
+def _process_in_worker(item, image_root, submitted_at, endpoint):
+    """在工作进程中处理样本，返回 (结果记录, 处理过程中新剔除的端点)"""
+    ejected = set(_worker_client.endpoints.ejected)
+    record = _worker_client.process_item(item, image_root, submitted_at, endpoint)
+    return record, [u for u in _worker_client.endpoints.ejected if u not in ejected]
+
+def run_process_engine(client, items, image_root, writer, total_samples, max_workers, num_pending, queue_size,
+                       limiter=None):
+    """多进程推理：工作进程发送阻塞请求并返回结果，主进程负责写入
+
+    items 为惰性迭代器，最多只有 queue_size 个任务同时提交到进程池，
+    内存占用与数据集大小无关。指定 limiter 时在途任务数由自适应并发控制决定。
+    客户端在每个工作进程中只初始化一次；端点由主进程按全局在途请求数选择
+    后随任务下发，工作进程剔除的端点回报给主进程，负载均衡和剔除对所有
+    工作进程生效。
+    """
+    endpoints = client.endpoints
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                                initargs=(client,)) as executor, \
+            tqdm(total=num_pending, desc="处理进度") as pbar:
+        pending = {}  # future -> (发出时间, 主进程选择的端点)
+        items = iter(items)
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and (limiter.has_capacity() if limiter is not None else len(pending) < queue_size):
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                started = limiter.start() if limiter is not None else None
+                if endpoints.ejected:
+                    endpoints.revive_due()
+                url = endpoints.acquire()
+                future = executor.submit(_process_in_worker, item, image_root, time.time(), url)
+                pending[future] = (started, url)
+            if not pending:
+                break
+
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                started, url = pending.pop(future)
+                if url is not None:
+                    endpoints.release(url)
+                record = None
+                try:
+                    record, ejected = future.result()
+                    for ejected_url in ejected:
+                        endpoints.eject(ejected_url)
+                    writer.write(record)
+                except Exception as e:
+                    print(f"处理异常: {str(e)}")
+                finally:
+                    if limiter is not None:
+                        limiter.finish(started, record)
+                    _progress(pbar, writer, total_samples, limiter)
+
+async def run_async_engine(client, items, image_root, writer, total_samples, concurrency, num_pending, queue_size,
+                           limiter=None):
+    """单进程 asyncio 推理：通过连接池保持最多 concurrency 个请求同时在途
+
+    生产者从惰性迭代器读取样本放入有界队列，concurrency 个消费协程取出处理。
+    指定 limiter 时每次 HTTP 请求发出前需等待自适应并发控制放行。
+    """
+    if aiohttp is None:
+        raise RuntimeError("--engine async 需要安装 aiohttp: pip install aiohttp")
+
+    queue = asyncio.Queue(maxsize=queue_size)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async def producer():
+        for item in items:
+            await queue.put((item, time.time()))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def consumer():
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                return
+            item, submitted_at = entry
+            try:
+                writer.write(await client.process_item_async(session, item, image_root, submitted_at, limiter))
+            except Exception as e:
+                print(f"处理异常: {str(e)}")
+            finally:
+                _progress(pbar, writer, total_samples, limiter)
+
+    with tqdm(total=num_pending, desc="处理进度") as pbar:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await asyncio.gather(producer(), *(consumer() for _ in range(concurrency)))
+
+# ========================
+# 5. 主函数
+# ========================
+def add_engine_arguments(parser):
+    """推理引擎、缓存、重试与并发控制相关的参数（main 与 sweep 共用）"""
+    parser.add_argument("--api_url", nargs="+", default=["http://127.0.0.1:8000"],
+                        help="服务地址，可指定多个（空格或逗号分隔），按最少在途请求数负载均衡")
+    parser.add_argument("--max_workers", type=int, default=3, help="最大工作进程数")
+    parser.add_argument("--engine", choices=["process", "async"], default="process",
+                        help="推理引擎: process 为多进程阻塞请求, async 为单进程 asyncio 并发请求")
+    parser.add_argument("--concurrency", type=int, default=64, help="async 引擎最大在途请求数")
+    parser.add_argument("--queue_size", type=int, default=None,
+                        help="待处理样本队列长度，默认为并发数的 2 倍")
+    parser.add_argument("--image_cache_dir", default=None,
+                        help="图像编码缓存目录，可先用 prepare_image_cache 子命令预填充")
+    parser.add_argument("--cache", choices=["read", "refresh", "off"], default="off",
+                        help="响应缓存模式: read 读穿缓存, refresh 重新请求并覆盖缓存, off 不使用")
+    parser.add_argument("--cache_path", default="./response_cache.sqlite", help="响应缓存 SQLite 文件路径")
+    parser.add_argument("--cache_max_mb", type=float, default=2048, help="响应缓存大小上限 (MB)")
+    parser.add_argument("--report_interval", type=float, default=30,
+                        help="每隔多少秒打印一次吞吐与延迟摘要，0 表示不打印")
+    parser.add_argument("--stats_every", type=int, default=100, help="每处理多少条结果更新一次 _stats.json")
+    parser.add_argument("--stats_interval", type=float, default=5.0, help="至少每隔多少秒更新一次 _stats.json")
+    parser.add_argument("--verify_stats", action="store_true",
+                        help="结束时重新扫描结果文件和错误文件，核对增量统计")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="根据延迟、429/503 和超时自适应调整在途请求数（AIMD），"
+                             "上限为 --max_workers / --concurrency")
+    parser.add_argument("--min_concurrency", type=int, default=1, help="自适应并发的下限")
+    parser.add_argument("--target_latency", type=float, default=None,
+                        help="自适应并发的目标延迟（秒），请求延迟超过该值时降低并发；默认只对过载作出反应")
+    parser.add_argument("--request_timeout", type=float, default=100, help="单次请求超时（秒），每次重试增加 5 秒")
+    parser.add_argument("--max_connect_retries", type=int, default=RETRY_BUDGETS["connect"],
+                        help="连接失败的重试预算")
+    parser.add_argument("--max_overload_retries", type=int, default=RETRY_BUDGETS["overload"],
+                        help="服务端过载（429/503/超时）的重试预算")
+    parser.add_argument("--max_other_retries", type=int, default=RETRY_BUDGETS["other"],
+                        help="其他错误（5xx、响应无法解析等）的重试预算")
+
+def add_image_arguments(parser, transport=True):
+    """图像编码与传输参数（编码参数同时决定图像缓存键）"""
+    parser.add_argument("--image_format", choices=["JPEG", "PNG", "WEBP"], default=IMAGE_FORMAT,
+                        help="base64 传输时图像重新编码的格式")
+    parser.add_argument("--image_quality", type=int, default=IMAGE_QUALITY, help="JPEG / WEBP 编码质量")
+    parser.add_argument("--max_pixels", type=int, default=None,
+                        help="编码前把图像等比例缩小到该像素数以内，建议与模型一致（训练时 MAX_PIXELS=262144）")
+    if transport:
+        parser.add_argument("--image_transport", choices=["base64", "file", "url"], default="base64",
+                            help="图像传输方式: base64 为 data URL，file 为服务端可读的本地路径"
+                                 "（vLLM 需 --allowed-local-media-path），url 为 --image_url_prefix 下的地址")
+        parser.add_argument("--image_url_prefix", default=None,
+                            help="--image_transport url 时的地址前缀，拼接样本中的相对图像路径")
+
+def build_image_cache(args, default_dir=None):
+    """按图像编码参数建立图像缓存，未指定目录时返回 None"""
+    cache_dir = args.image_cache_dir or default_dir
+    if not cache_dir:
+        return None
+    return ImageCache(cache_dir, args.image_format, args.image_quality, args.max_pixels)
+
+def build_endpoints(args):
+    """由 --api_url 建立端点池并探测可用端点"""
+    endpoints = EndpointPool([u for arg in args.api_url for u in arg.split(",") if u])
+    healthy = endpoints.check_all()
+    print(f"可用服务端点: {len(healthy)}/{len(endpoints.urls)} {healthy}")
+    return endpoints
+
+def build_client(args, endpoints, model_name, image_cache, response_cache, sampling=None, n=1):
+    image_policy = ImagePolicy(args.image_format, args.image_quality, args.max_pixels, args.image_transport,
+                               args.image_url_prefix)
+    return VLMessageClient(
+        endpoints, model_name, image_cache, response_cache, args.request_timeout,
+        {"connect": args.max_connect_retries, "overload": args.max_overload_retries,
+         "other": args.max_other_retries},
+        sampling, n, image_policy
+    )
+
+def run_engine(args, client, items, image_root, writer, total_samples, num_pending):
+    """按 --engine 运行推理引擎，返回本次运行的吞吐与延迟汇总"""
+    limiter = None
+    if args.adaptive:
+        max_limit = args.concurrency if args.engine == "async" else args.max_workers
+        limiter = AdaptiveConcurrency(max_limit, args.min_concurrency, target_latency=args.target_latency)
+        print(f"自适应并发: 上限 {max_limit}，初始 {int(limiter.limit)}")
+
+    if args.engine == "async":
+        print(f"开始处理剩余记录，使用 async 引擎，最大在途请求数 {args.concurrency}...")
+        asyncio.run(run_async_engine(
+            client, items, image_root, writer, total_samples, args.concurrency,
+            num_pending, args.queue_size or args.concurrency * 2, limiter
+        ))
+    else:
         print(f"开始处理剩余记录，使用 {args.max_workers} 个工作进程...")
+        run_process_engine(
+            client, items, image_root, writer, total_samples, args.max_workers,
+            num_pending, args.queue_size or args.max_workers * 2, limiter
+        )
+
+    performance = writer.metrics.summary()
+    if limiter is not None:
+        performance["adaptive_concurrency"] = limiter.summary()
+        print(f"自适应并发: 最终 {limiter.limit:.1f}，峰值 {limiter.peak:.1f}，降低 {limiter.decreases} 次")
+    latency = performance["http_latency"]
+    print(f"本次运行: {performance['requests']} 条，{performance['requests_per_second']} 条/s，"
+          f"生成 {performance['completion_tokens_per_second']} tokens/s，"
+          f"延迟 p50 {latency['p50']}s p95 {latency['p95']}s p99 {latency['p99']}s，"
+          f"重试 {performance['retries']} 次")
+    return performance
 
-        # 确保错误文件存在
-        if not os.path.exists(error_output_path):
-            open(error_output_path, 'w').close()
-
-        with Manager() as manager:
-            total_counter = manager.Value('i', recovered_total)
-            correct_counter = manager.Value('i', recovered_correct)
-            lock = manager.Lock()
-
-            with concurrent.futures.ProcessPoolExecutor(max_workers=args.max_workers) as executor:
-                futures = []
-                client = VLMessageClient(args.api_url, args.model_name)
-
-                for item in remaining_data:
-                    futures.append(
-                        executor.submit(
-                            client.process_item,
-                            item=item,
-                            image_root=args.image_root,
-                            output_file=args.output_path,
-                            error_file=error_output_path,
-                            total_counter=total_counter,
-                            correct_counter=correct_counter,
-                            lock=lock
-                        )
-                    )
-
-                # 5. 进度条
-                with tqdm(total=len(remaining_data), desc="处理进度") as pbar:
-                    for future in concurrent.futures.as_completed(futures):
-                        try:
-                            future.result()
-                        except Exception as e:
-                            print(f"处理异常: {str(e)}")
-                        finally:
-                            pbar.update(1)
-                            current_total = total_counter.value
-                            current_correct = correct_counter.value
-                            processed_info = f"{current_total}/{total_samples}"
-
-                            # 避免除零错误
-                            if current_total > 0:
-                                accuracy_info = f"{current_correct/current_total:.2%}"
-                            else:
-                                accuracy_info = "N/A"
-
-                            pbar.set_postfix({
-                                "当前正确": current_correct,
-                                "当前总数": current_total,
-                                "准确率": accuracy_info,
-                                "已处理": processed_info
-                            })
-
-    # 6. 最终统计
+def pass_at_k(n, c, k):
+    """n 个采样中有 c 个正确时 pass@k 的无偏估计 1 - C(n-c, k) / C(n, k)"""
+    if n - c < k:
+        return 1.0
+    result = 1.0
+    for i in range(n - c + 1, n + 1):
+        result *= 1.0 - k / i
+    return 1.0 - result
+
+def scan_results(output_file, error_file, ks=()):
+    """扫描结果文件与错误文件做最终统计（按 item_id 去重，之后重试成功的样本不再计为失败）
+
+    Returns:
+        tuple: (成功数, 失败数, 正确数, {k: pass@k})；没有多采样结果时 pass@k 按单个结果计算
+    """
     # 统计成功文件
-    success_count = 0
+    success_ids = set()
     correct_count = 0
-    if os.path.exists(args.output_path):
-        with open(args.output_path, "r") as f:
+    pass_sums = {k: 0.0 for k in ks}
+    if os.path.exists(output_file):
+        with open(output_file, "r", encoding="utf-8") as f:
             for line in f:
                 try:
                     data = json.loads(line)
                     if data.get("success", False):
-                        success_count += 1
-                        if data.get("is_correct", False):
-                            correct_count += 1
+                        key = record_key(data)
+                        if key not in success_ids:
+                            success_ids.add(key)
+                            if data.get("is_correct", False):
+                                correct_count += 1
+                            n = data.get("n", 1)
+                            c = data.get("num_correct", int(bool(data.get("is_correct", False))))
+                            for k in ks:
+                                pass_sums[k] += pass_at_k(n, c, min(k, n))
                 except:
                     continue
+    success_count = len(success_ids)
 
     # 统计错误文件
-    error_count = 0
-    if os.path.exists(error_output_path):
-        with open(error_output_path, "r") as f:
+    error_ids = set()
+    if os.path.exists(error_file):
+        with open(error_file, "r", encoding="utf-8") as f:
             for line in f:
                 try:
                     data = json.loads(line)
                     if not data.get("success", True):
-                        error_count += 1
+                        key = record_key(data)
+                        if key is not None and key not in success_ids:
+                            error_ids.add(key)
                 except:
                     continue
+    error_count = len(error_ids)
 
+    pass_rates = {k: pass_sums[k] / success_count if success_count else 0 for k in ks}
+    return success_count, error_count, correct_count, pass_rates
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", required=True, help="模型名称")
+    parser.add_argument("--prompt_path", required=True, help="测试集路径")
+    parser.add_argument("--image_root", default="../", help="图像根目录")
+    parser.add_argument("--output_path", required=True, help="输出文件路径")
+    add_engine_arguments(parser)
+    add_image_arguments(parser)
+    args = parser.parse_args()
+    image_cache = build_image_cache(args)
+    response_cache = ResponseCache(args.cache_path, args.cache, args.cache_max_mb) if args.cache != "off" else None
+
+    # 设置错误文件路径
+    error_output_path = os.path.splitext(args.output_path)[0] + "_errors.jsonl"
+
+    # 1. 加载测试数据
+    total_samples = count_prompts(args.prompt_path)
+    print(f"测试集总数: {total_samples}")
+    print(f"使用模型: {args.model_name}")
+
+    # 2. 恢复已成功处理的数据（只恢复success为true的记录）
+    if os.path.exists(args.output_path):
+        print("检查输出文件...")
+    else:
+        print("输出文件不存在，创建新文件")
+    processed_success, recovered_total, recovered_correct = recover_results(
+        args.output_path, index_path_for(args.output_path)
+    )
+
+    # 安全打印恢复统计信息
+    print(f"已成功恢复记录数: {recovered_total} ({recovered_total/total_samples:.2%})")
+    if recovered_total > 0:
+        print(f"已恢复正确记录数: {recovered_correct} ({recovered_correct/recovered_total:.2%})")
+    else:
+        print(f"已恢复正确记录数: 0 (N/A)")
+
+    # 3. 确定剩余待处理数据（所有未成功的数据），边读边过滤
+    remaining_data = (item for item in iter_prompts(args.prompt_path)
+                      if item["item_id"] not in processed_success)
+    first_item = next(remaining_data, None)
+    num_pending = max(total_samples - recovered_total, 0) if first_item is not None else 0
+
+    print(f"剩余待处理记录数: {num_pending}")
+
+    # 4. 处理剩余数据，_stats.json 在处理过程中增量更新
+    stats_path = os.path.splitext(args.output_path)[0] + "_stats.json"
+    stats = StatsWriter(stats_path, {
+        "model_name": args.model_name,
+        "output_file": args.output_path,
+        "error_file": error_output_path
+    }, total_samples, num_pending, args.stats_every, args.stats_interval)
+    performance = None
+    metrics = RunMetrics(args.report_interval)
+    with ResultWriter(args.output_path, error_output_path, recovered_total, recovered_correct,
+                      metrics=metrics, stats=stats) as writer:
+        stats.write(writer)
+        if first_item is not None:
+            remaining_data = itertools.chain([first_item], remaining_data)
+            client = build_client(args, build_endpoints(args), args.model_name, image_cache, response_cache)
+            try:
+                performance = run_engine(args, client, remaining_data, args.image_root, writer, total_samples,
+                                         num_pending)
+            except BaseException as e:
+                # 中断或异常退出时也写出已落盘结果的统计，监控脚本不会读到过时的进度
+                stats.write(writer, "interrupted" if isinstance(e, KeyboardInterrupt) else "failed",
+                            writer.metrics.summary())
+                raise
+            if response_cache is not None:
+                response_cache.trim()
+
+        # 5. 最终统计直接使用累计计数；--verify_stats 时重新扫描结果文件核对
+        #    （按 item_id 去重，之后重试成功的样本不再计为失败）
+        counts = (writer.total, writer.failed, writer.correct)
+        if args.verify_stats:
+            writer.flush()
+            scanned = scan_results(args.output_path, error_output_path)[:3]
+            if scanned != counts:
+                print(f"警告: 增量统计 (成功, 失败, 正确) = {counts} 与重新扫描结果 {scanned} 不一致，以扫描结果为准")
+                counts = scanned
+            else:
+                print("增量统计与重新扫描结果一致")
+        stats.write(writer, "finished", performance, counts)
+
+    success_count, error_count, correct_count = counts
     total_processed = success_count + error_count
 
     # 避免除零错误
@@ -354,21 +1658,416 @@ def main():
 
     print(f"总处理记录数: {total_processed} (应与测试集总数一致: {'是' if total_processed == total_samples else '否'})")
 
-    # 保存统计文件
-    stats_path = os.path.splitext(args.output_path)[0] + "_stats.json"
+    print(f"统计信息已保存到: {stats_path}")
+
+# ========================
+# 6. 图像缓存预填充
+# ========================
+def _warm_image(cache, image_path):
+    """在子进程中编码单张图像，返回 (是否命中缓存, 错误信息)"""
+    try:
+        if cache.get(image_path) is not None:
+            return True, None
+        cache.put(image_path, encode_image(image_path, cache.fmt, cache.quality, cache.max_pixels))
+        return False, None
+    except Exception as e:
+        return False, str(e)
+
+def prepare_image_cache_main(argv=None):
+    """预先编码测试集中的全部图像并写入磁盘缓存"""
+    parser = argparse.ArgumentParser(prog="inference.py prepare_image_cache")
+    parser.add_argument("--prompt_path", required=True, nargs="+", help="测试集路径，可指定多个")
+    parser.add_argument("--image_root", default="../", help="图像根目录")
+    parser.add_argument("--image_cache_dir", required=True, help="图像编码缓存目录")
+    parser.add_argument("--max_workers", type=int, default=os.cpu_count(), help="编码进程数")
+    add_image_arguments(parser, transport=False)
+    args = parser.parse_args(argv)
+
+    cache = build_image_cache(args)
+    image_paths = []
+    seen = set()
+    for prompt_path in args.prompt_path:
+        with open(prompt_path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                image_path = resolve_image_path(json.loads(line), args.image_root)
+                if image_path not in seen:
+                    seen.add(image_path)
+                    image_paths.append(image_path)
+    print(f"待处理图像数: {len(image_paths)}")
+
+    hits = encoded = failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.max_workers) as executor:
+        results = executor.map(_warm_image, [cache] * len(image_paths), image_paths, chunksize=16)
+        for image_path, (hit, error) in tqdm(zip(image_paths, results), total=len(image_paths), desc="编码图像"):
+            if error is not None:
+                failed += 1
+                print(f"编码失败 {image_path}: {error}")
+            elif hit:
+                hits += 1
+            else:
+                encoded += 1
+
+    print(f"已缓存: {hits}，新编码: {encoded}，失败: {failed}")
+    print(f"缓存目录: {args.image_cache_dir}")
+
+# ========================
+# 7. 离线重新评分
+# ========================
+def _rescore_range(path, start, end, keep_records):
+    """重新评分文件中 [start, end) 字节范围内的结果行（含 n > 1 时的 model_outputs）
+
+    返回 [(样本键, 原是否正确, 新是否正确, 新记录或 None)]；只统计时不回传
+    记录本身，减少进程间传输。
+    """
+    scored = []
+    with open(path, "rb") as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not record.get("success", False):
+                continue
+            old_correct = bool(record.get("is_correct", False))
+            ground_truth = record.get("ground_truth") or ""
+            pred, is_correct = score_output(record.get("model_output") or "", ground_truth)
+            record["extracted_answer"] = str(pred[0]) if pred else None
+            record["is_correct"] = is_correct
+            # 多采样结果：全部重新评分，num_correct 随之更新，pass@k 使用新的解析结果
+            if record.get("model_outputs"):
+                scored_outputs = [score_output(o or "", ground_truth) for o in record["model_outputs"]]
+                record["extracted_answers"] = [str(p[0]) if p else None for p, _ in scored_outputs]
+                record["num_correct"] = sum(int(c) for _, c in scored_outputs)
+            scored.append((record_key(record), old_correct, is_correct, record if keep_records else None))
+    return scored
+
+def _split_ranges(path, chunk_bytes):
+    """把文件按行边界切分为若干字节范围"""
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def rescore_main(argv=None):
+    """用当前的 safe_parse / safe_verify 对已有结果重新评分，不访问服务端"""
+    parser = argparse.ArgumentParser(prog="inference.py rescore")
+    parser.add_argument("--results_path", required=True, help="已有的结果 JSONL")
+    parser.add_argument("--output_path", default=None, help="重新评分后的结果写入路径，默认不写出记录")
+    parser.add_argument("--max_workers", type=int, default=os.cpu_count(), help="评分进程数")
+    parser.add_argument("--chunk_mb", type=float, default=8, help="每个任务处理的文件块大小 (MB)")
+    parser.add_argument("--parallel_threshold_mb", type=float, default=32,
+                        help="结果文件超过该大小才使用多进程，小文件单进程更快")
+    args = parser.parse_args(argv)
+    # 输出文件会在读取结果文件之前被清空，也会使结果文件的续跑索引失效，不允许原地覆盖
+    if args.output_path and (os.path.abspath(args.output_path) == os.path.abspath(args.results_path) or (
+            os.path.exists(args.output_path) and os.path.samefile(args.output_path, args.results_path))):
+        parser.error("--output_path 不能与 --results_path 相同，请写到新的文件")
+
+    start = time.time()
+    # 各进程按字节范围直接读取结果文件，只回传评分结果
+    ranges = _split_ranges(args.results_path, int(args.chunk_mb * 1024 * 1024))
+    task_args = ([args.results_path] * len(ranges), [r[0] for r in ranges], [r[1] for r in ranges],
+                 [args.output_path is not None] * len(ranges))
+    use_pool = (args.max_workers > 1 and
+                os.path.getsize(args.results_path) > args.parallel_threshold_mb * 1024 * 1024)
+    if use_pool:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.max_workers)
+        scored_chunks = pool.map(_rescore_range, *task_args)
+    else:
+        pool = None
+        scored_chunks = map(_rescore_range, *task_args)
+
+    seen = set()
+    total = correct = flipped_to_correct = flipped_to_wrong = 0
+    out_f = open(args.output_path, "w", encoding="utf-8") if args.output_path else None
+    try:
+        for scored in scored_chunks:
+            for key, old_correct, is_correct, record in scored:
+                if key in seen:
+                    continue
+                seen.add(key)
+                total += 1
+                correct += int(is_correct)
+                flipped_to_correct += int(is_correct and not old_correct)
+                flipped_to_wrong += int(old_correct and not is_correct)
+                if out_f is not None:
+                    record["current_correct"] = correct
+                    record["current_total"] = total
+                    record["current_accuracy"] = float(correct) / float(total)
+                    out_f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    finally:
+        if out_f is not None:
+            out_f.close()
+        if pool is not None:
+            pool.shutdown()
+
+    accuracy = correct / total if total > 0 else 0
+    elapsed = time.time() - start
+    print(f"重新评分记录数: {total}")
+    print(f"正确结果数: {correct} ({accuracy:.2%})")
+    print(f"由错变对: {flipped_to_correct}，由对变错: {flipped_to_wrong}")
+    print(f"耗时: {elapsed:.3f}s")
+
+    stats_path = os.path.splitext(args.output_path or args.results_path)[0] + "_rescore_stats.json"
     with open(stats_path, "w") as f:
         json.dump({
-            "total_samples": total_samples,
-            "model_name": args.model_name,
+            "results_file": args.results_path,
+            "successful_inferences": total,
+            "correct_results": correct,
+            "accuracy": accuracy,
+            "flipped_to_correct": flipped_to_correct,
+            "flipped_to_wrong": flipped_to_wrong,
+            "elapsed_seconds": elapsed
+        }, f, indent=4)
+    print(f"统计信息已保存到: {stats_path}")
+
+# ========================
+# 8. 多模型 / 多数据集批量评测（sweep）
+# ========================
+def parse_sampling(spec):
+    """解析采样配置 "名称:key=value,key=value"，返回 (名称, 采样参数, n)
+
+    例如 "greedy"（贪心解码）或 "t07:temperature=0.7,top_p=0.95,n=8"；
+    未指定的参数使用 DEFAULT_SAMPLING。
+    """
+    name, _, params_text = spec.partition(":")
+    params = {}
+    for pair in filter(None, params_text.split(",")):
+        key, _, value = pair.partition("=")
+        try:
+            params[key.strip()] = json.loads(value)
+        except ValueError:
+            params[key.strip()] = value
+    n = int(params.pop("n", 1))
+    return name, params, n
+
+def _safe_name(name):
+    """把模型名等转换为可作为目录名的字符串"""
+    return re.sub(r"[^\w.\-]+", "_", name).strip("_") or "_"
+
+def _interleave(iterators):
+    """轮流从多个迭代器中取元素，直到全部耗尽"""
+    iterators = list(iterators)
+    while iterators:
+        alive = []
+        for it in iterators:
+            value = next(it, None)
+            if value is not None:
+                alive.append(it)
+                yield value
+        iterators = alive
+
+class SweepClient:
+    """sweep 中全部评测单元共用的客户端
+
+    样本带有 _cell 字段，按评测单元分派给对应模型和采样参数的
+    VLMessageClient（使用该单元数据集的图像根目录），返回的记录同样带上
+    _cell，由 SweepWriter 写入该单元的结果文件。
+    """
+    def __init__(self, cells, endpoints):
+        self.cells = {cell_id: (cell["client"], cell["image_root"]) for cell_id, cell in cells.items()}
+        self.endpoints = endpoints
+
+    def process_item(self, item, image_root, submitted_at=None, endpoint=None):
+        client, cell_image_root = self.cells[item["_cell"]]
+        record = client.process_item(item, cell_image_root, submitted_at, endpoint)
+        record["_cell"] = item["_cell"]
+        return record
+
+    async def process_item_async(self, session, item, image_root, submitted_at=None, limiter=None):
+        client, cell_image_root = self.cells[item["_cell"]]
+        record = await client.process_item_async(session, item, cell_image_root, submitted_at, limiter)
+        record["_cell"] = item["_cell"]
+        return record
+
+class SweepWriter:
+    """按 _cell 把结果分派给各评测单元的 ResultWriter，并汇总整体吞吐"""
+    def __init__(self, writers, metrics):
+        self.writers = writers
+        self.metrics = metrics
+
+    def write(self, record):
+        self.metrics.observe(record)
+        self.writers[record.pop("_cell")].write(record)
+
+    def postfix(self, total_samples):
+        done = sum(w.total for w in self.writers.values())
+        return {"已处理": f"{done}/{total_samples}", "评测单元": len(self.writers)}
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def sweep_main(argv=None):
+    """对 (模型, 数据集, 采样配置, n) 矩阵批量评测
+
+    所有评测单元的样本轮流交错进入同一个队列，共用端点池、图像缓存和响应
+    缓存，单元之间没有空档；每个单元有独立的结果文件、续跑索引和统计文件。
+    """
+    parser = argparse.ArgumentParser(prog="inference.py sweep")
+    parser.add_argument("--model_names", required=True, nargs="+", help="模型名称，可指定多个")
+    parser.add_argument("--prompt_path", required=True, nargs="+", help="测试集路径，可指定多个")
+    parser.add_argument("--dataset_names", nargs="+", default=None, help="数据集名称，默认为测试集文件名")
+    parser.add_argument("--image_root", nargs="+", default=["../"],
+                        help="图像根目录，一个（所有数据集共用）或与 --prompt_path 一一对应")
+    parser.add_argument("--sampling", nargs="+", default=["greedy"],
+                        help="采样配置，格式为 名称:key=value,...，例如 t07:temperature=0.7,top_p=0.95,n=8；"
+                             "n 大于 1 时使用服务端的 n 参数一次返回 n 个结果")
+    parser.add_argument("--output_dir", required=True, help="输出目录，结果写入 <模型>/<数据集>/<采样配置>/ 下")
+    add_engine_arguments(parser)
+    add_image_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if len(args.image_root) not in (1, len(args.prompt_path)):
+        parser.error("--image_root 的数量必须为 1 或与 --prompt_path 相同")
+    dataset_names = args.dataset_names or [os.path.splitext(os.path.basename(p))[0] for p in args.prompt_path]
+    if len(dataset_names) != len(args.prompt_path):
+        parser.error("--dataset_names 的数量必须与 --prompt_path 相同")
+    image_roots = args.image_root * len(args.prompt_path) if len(args.image_root) == 1 else args.image_root
+    samplings = [parse_sampling(spec) for spec in args.sampling]
+
+    image_cache = build_image_cache(args, os.path.join(args.output_dir, "image_cache"))
+    response_cache = ResponseCache(args.cache_path, args.cache, args.cache_max_mb) if args.cache != "off" else None
+    endpoints = build_endpoints(args)
+
+    # 1. 建立评测单元并恢复各自已完成的样本
+    cells = {}
+    for model_name in args.model_names:
+        for prompt_path, dataset_name, image_root in zip(args.prompt_path, dataset_names, image_roots):
+            total_samples = count_prompts(prompt_path)
+            for sampling_name, sampling, n in samplings:
+                cell_id = f"{model_name}/{dataset_name}/{sampling_name}"
+                cell_dir = os.path.join(args.output_dir, _safe_name(model_name), _safe_name(dataset_name),
+                                        _safe_name(sampling_name))
+                os.makedirs(cell_dir, exist_ok=True)
+                output_path = os.path.join(cell_dir, "results.jsonl")
+                processed, recovered_total, recovered_correct = recover_results(
+                    output_path, index_path_for(output_path)
+                )
+                cells[cell_id] = {
+                    "model_name": model_name,
+                    "dataset": dataset_name,
+                    "prompt_path": prompt_path,
+                    "image_root": image_root,
+                    "sampling_name": sampling_name,
+                    "sampling": dict(DEFAULT_SAMPLING, **sampling),
+                    "n": n,
+                    "total_samples": total_samples,
+                    "output_path": output_path,
+                    "error_path": os.path.join(cell_dir, "results_errors.jsonl"),
+                    "processed": processed,
+                    "recovered_total": recovered_total,
+                    "recovered_correct": recovered_correct,
+                    "client": build_client(args, endpoints, model_name, image_cache, response_cache, sampling, n),
+                }
+                print(f"[{cell_id}] 测试集 {total_samples} 条，已完成 {recovered_total} 条，n={n}")
+
+    def pending_items(cell_id, cell):
+        for item in iter_prompts(cell["prompt_path"]):
+            if item["item_id"] not in cell["processed"]:
+                item["_cell"] = cell_id
+                yield item
+
+    total_samples = sum(cell["total_samples"] for cell in cells.values())
+    num_pending = sum(max(cell["total_samples"] - cell["recovered_total"], 0) for cell in cells.values())
+    print(f"评测单元数: {len(cells)}，样本总数: {total_samples}，剩余待处理: {num_pending}")
+
+    # 2. 所有单元的样本交错进入同一个队列
+    performance = None
+    if num_pending > 0:
+        items = _interleave(pending_items(cell_id, cell) for cell_id, cell in cells.items())
+        writers = {
+            cell_id: ResultWriter(
+                cell["output_path"], cell["error_path"], cell["recovered_total"], cell["recovered_correct"],
+                metrics=RunMetrics(0),
+                stats=StatsWriter(
+                    os.path.splitext(cell["output_path"])[0] + "_stats.json",
+                    {"model_name": cell["model_name"], "dataset": cell["dataset"],
+                     "sampling_name": cell["sampling_name"], "n": cell["n"]},
+                    cell["total_samples"], max(cell["total_samples"] - cell["recovered_total"], 0),
+                    args.stats_every, args.stats_interval
+                )
+            )
+            for cell_id, cell in cells.items()
+        }
+        with SweepWriter(writers, RunMetrics(args.report_interval)) as writer:
+            try:
+                performance = run_engine(args, SweepClient(cells, endpoints), items, None, writer, total_samples,
+                                         num_pending)
+            except BaseException as e:
+                status = "interrupted" if isinstance(e, KeyboardInterrupt) else "failed"
+                for cell_writer in writers.values():
+                    cell_writer.stats.write(cell_writer, status, cell_writer.metrics.summary())
+                raise
+        if response_cache is not None:
+            response_cache.trim()
+        for cell_id, cell in cells.items():
+            cell["performance"] = writers[cell_id].metrics.summary()
+
+    # 3. 各单元统计（含 pass@k，需要扫描结果文件）与汇总
+    summary = []
+    print("\n最终统计:")
+    for cell_id, cell in cells.items():
+        n = cell["n"]
+        ks = sorted({k for k in (1, 2, 4, 8, 16, 32, 64, 128) if k <= n} | {n})
+        success_count, error_count, correct_count, pass_rates = scan_results(
+            cell["output_path"], cell["error_path"], ks
+        )
+        stats = {
+            "model_name": cell["model_name"],
+            "dataset": cell["dataset"],
+            "prompt_path": cell["prompt_path"],
+            "sampling_name": cell["sampling_name"],
+            "sampling": cell["sampling"],
+            "n": n,
+            "total_samples": cell["total_samples"],
             "successful_inferences": success_count,
             "failed_inferences": error_count,
             "correct_results": correct_count,
-            "accuracy": final_accuracy,
-            "output_file": args.output_path,
-            "error_file": error_output_path
-        }, f, indent=4)
+            "accuracy": correct_count / success_count if success_count > 0 else 0,
+            "pass_at_k": {f"pass@{k}": rate for k, rate in pass_rates.items()},
+            "output_file": cell["output_path"],
+            "error_file": cell["error_path"],
+            "status": "finished",
+            "performance": cell.get("performance")
+        }
+        write_json_atomic(os.path.splitext(cell["output_path"])[0] + "_stats.json", stats)
+        summary.append(stats)
+        pass_text = "  ".join(f"{name} {rate:.2%}" for name, rate in stats["pass_at_k"].items())
+        print(f"[{cell_id}] 成功 {success_count}/{cell['total_samples']}，失败 {error_count}，{pass_text}")
 
-    print(f"统计信息已保存到: {stats_path}")
+    summary_path = os.path.join(args.output_dir, "sweep_summary.json")
+    with open(summary_path, "w") as f:
+        json.dump({"cells": summary, "performance": performance}, f, indent=4)
+    print(f"汇总统计已保存到: {summary_path}")
+
+COMMANDS = {
+    "prepare_image_cache": prepare_image_cache_main,
+    "rescore": rescore_main,
+    "sweep": sweep_main,
+}
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        main()
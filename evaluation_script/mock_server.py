@@ -0,0 +1,253 @@
+"""
+本地模拟的 OpenAI 兼容推理服务，用于在没有 GPU / vLLM 的机器上测量
+inference.py 客户端的吞吐
+
+只实现 inference.py 用到的两个接口：
+    GET  /v1/models            与 check_vllm_service.sh 的探测一致
+    POST /v1/chat/completions  按配置的延迟、抖动、错误率和输出长度返回；
+                               指定 --capacity 时在途请求超过容量直接返回 429，模拟服务端过载；
+                               支持 stream=true（SSE），用于测量首 token 延迟
+
+--prefill_per_token 按提示 token 数模拟预填充耗时，加上 --prefix_caching 时与之前
+请求相同的系统消息视为命中前缀缓存，不计预填充耗时（与 vLLM 自动前缀缓存类似）。
+
+用法:
+    python3 mock_server.py --port 8111 --latency 0.5 --jitter 0.2 --error_rate 0.01 --output_tokens 256
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class MockConfig:
+    """模拟服务的行为参数"""
+    def __init__(self, model_name="mock-model", latency=0.5, jitter=0.0, error_rate=0.0, error_status=503,
+                 output_tokens=256, seed=None, capacity=None, prefill_per_token=0.0, prefix_caching=False):
+        self.model_name = model_name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.output_tokens = output_tokens
+        self.capacity = capacity
+        self.prefill_per_token = prefill_per_token
+        self.prefix_caching = prefix_caching
+        self.cached_prefixes = set()
+        self.in_flight = 0
+        self.rejected = 0
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def admit(self):
+        """占用一个并发名额，超过容量时返回 False"""
+        with self.lock:
+            if self.capacity is not None and self.in_flight >= self.capacity:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def sample(self):
+        """抽取一次请求的 (延迟秒数, 是否返回错误)"""
+        with self.lock:
+            self.requests += 1
+            delay = max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0.0)
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return delay, failed
+
+    def prefill(self, payload):
+        """返回 (预填充秒数, 命中前缀缓存的 token 数)"""
+        total = estimate_prompt_tokens(payload)
+        cached = 0
+        messages = payload.get("messages") or []
+        if self.prefix_caching and messages and messages[0].get("role") == "system":
+            system = json.dumps(messages[0], sort_keys=True).encode("utf-8")
+            key = hashlib.sha1(system).hexdigest()
+            with self.lock:
+                if key in self.cached_prefixes:
+                    cached = estimate_prompt_tokens({"messages": messages[:1]})
+                else:
+                    self.cached_prefixes.add(key)
+        return (total - cached) * self.prefill_per_token, cached
+
+    def make_output(self):
+        """生成 output_tokens 个词的推理过程和一个 <answer> 标签"""
+        with self.lock:
+            answer = self.random.choice([30, 40, 50, 60, 65, 70, 80, 100, 120, 140])
+        thinking = " ".join(["step"] * max(self.output_tokens - 4, 0))
+        return f"<think>{thinking}</think><answer>{answer}</answer>"
+
+def estimate_prompt_tokens(payload):
+    """粗略估计提示 token 数：文本按空格分词，每张图计 256 个 token"""
+    tokens = 0
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content.split())
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += len(part.get("text", "").split())
+            else:
+                tokens += 256
+    return tokens
+
+class MockHTTPServer(ThreadingHTTPServer):
+    # 默认的监听队列长度为 5，高并发建立连接时会丢弃 SYN，造成约 1 秒的额外延迟
+    request_queue_size = 1024
+    daemon_threads = True
+
+def make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, obj):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/") != "/v1/models":
+                return self._send(404, {"error": "not found"})
+            self._send(200, {
+                "object": "list",
+                "data": [{"id": config.model_name, "object": "model", "owned_by": "mock"}]
+            })
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                payload = json.loads(self.rfile.read(length))
+            except ValueError:
+                return self._send(400, {"error": "invalid json"})
+            if self.path.rstrip("/") != "/v1/chat/completions":
+                return self._send(404, {"error": "not found"})
+
+            if not config.admit():
+                return self._send(429, {"error": "too many requests"})
+            try:
+                delay, failed = config.sample()
+                prefill, cached_tokens = config.prefill(payload)
+                if failed:
+                    time.sleep(delay)
+                elif payload.get("stream"):
+                    return self._stream(payload, prefill, delay, cached_tokens)
+                else:
+                    time.sleep(prefill + delay)
+            finally:
+                config.leave()
+            if failed:
+                return self._send(config.error_status, {"error": "server overloaded"})
+
+            n = int(payload.get("n", 1))
+            self._send(200, {
+                "id": f"chatcmpl-mock-{config.requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": payload.get("model", config.model_name),
+                "choices": [
+                    {"index": i, "message": {"role": "assistant", "content": config.make_output()},
+                     "finish_reason": "stop"}
+                    for i in range(n)
+                ],
+                "usage": {
+                    "prompt_tokens": estimate_prompt_tokens(payload),
+                    "completion_tokens": config.output_tokens * n,
+                    "total_tokens": estimate_prompt_tokens(payload) + config.output_tokens * n,
+                    "prompt_tokens_details": {"cached_tokens": cached_tokens}
+                }
+            })
+
+        def _stream(self, payload, prefill, delay, cached_tokens):
+            """以 SSE 流式返回：预填充结束后发出第一个 token，解码耗时后发出其余内容"""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            def event(obj):
+                self.wfile.write(f"data: {json.dumps(obj)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            def chunk(content, finish_reason=None):
+                return {
+                    "object": "chat.completion.chunk",
+                    "model": payload.get("model", config.model_name),
+                    "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": finish_reason}]
+                }
+
+            completion_tokens = min(payload.get("max_tokens") or config.output_tokens, config.output_tokens)
+            output = config.make_output()
+            time.sleep(prefill)
+            event(chunk(output[:1]))
+            time.sleep(delay * completion_tokens / max(config.output_tokens, 1))
+            event(chunk(output[1:], "stop"))
+            event({
+                "object": "chat.completion.chunk",
+                "choices": [],
+                "usage": {
+                    "prompt_tokens": estimate_prompt_tokens(payload),
+                    "completion_tokens": completion_tokens,
+                    "prompt_tokens_details": {"cached_tokens": cached_tokens}
+                }
+            })
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+    return Handler
+
+def start_server(config, host="127.0.0.1", port=0):
+    """在后台线程中启动模拟服务，返回 (server, 服务地址)；port 为 0 时自动选择端口"""
+    server = MockHTTPServer((host, port), make_handler(config))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的 OpenAI 兼容推理服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8111, help="监听端口")
+    parser.add_argument("--model_name", default="mock-model", help="/v1/models 返回的模型名")
+    parser.add_argument("--latency", type=float, default=0.5, help="每个请求的平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟的均匀抖动幅度（秒）")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="返回错误的概率")
+    parser.add_argument("--error_status", type=int, default=503, help="错误响应的 HTTP 状态码")
+    parser.add_argument("--output_tokens", type=int, default=256, help="每个回答的 token 数")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子")
+    parser.add_argument("--capacity", type=int, default=None, help="同时处理的请求上限，超出时返回 429")
+    parser.add_argument("--prefill_per_token", type=float, default=0.0, help="每个未命中缓存的提示 token 的预填充耗时（秒）")
+    parser.add_argument("--prefix_caching", action="store_true", help="模拟前缀缓存：重复出现的系统消息不计预填充耗时")
+    args = parser.parse_args()
+
+    config = MockConfig(args.model_name, args.latency, args.jitter, args.error_rate, args.error_status,
+                        args.output_tokens, seed=args.seed, capacity=args.capacity,
+                        prefill_per_token=args.prefill_per_token, prefix_caching=args.prefix_caching)
+    server = MockHTTPServer((args.host, args.port), make_handler(config))
+    print(f"模拟服务已启动: http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"共收到请求 {config.requests} 个，返回错误 {config.errors} 个，超出容量拒绝 {config.rejected} 个")
+
+if __name__ == "__main__":
+    main()
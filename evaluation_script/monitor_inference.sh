@@ -3,21 +3,43 @@
 MAX_RETRIES=3
 TARGET_LINES=754
 OUTPUT_FILE="./result_geoqa/results_model_name.jsonl"
+# inference.py 在运行过程中增量更新的统计文件
+STATS_FILE="${OUTPUT_FILE%.jsonl}_stats.json"
 MAIN_SCRIPT="sh run_infer.sh"
 PROGRESS_LOG="progress.log"
 
 retry_count=0
 success=0
 
-# 获取当前结果行数
+# 读取统计文件中的字段，$1 为字段名
+read_stat() {
+    python3 -c "import json, sys; print(json.load(open(sys.argv[1])).get(sys.argv[2]))" "$STATS_FILE" "$1" 2>/dev/null
+}
+
+# 获取当前成功条数：优先读取统计文件，没有统计文件时（旧版本的结果）按行数统计
 get_current_lines() {
-    if [ -f "$OUTPUT_FILE" ]; then
+    if [ -f "$STATS_FILE" ]; then
+        read_stat successful_inferences || echo 0
+    elif [ -f "$OUTPUT_FILE" ]; then
         wc -l < "$OUTPUT_FILE"
     else
         echo 0
     fi
 }
 
+# 打印统计文件中的准确率、吞吐和预计剩余时间
+print_stats() {
+    if [ -f "$STATS_FILE" ]; then
+        python3 -c "
+import json, sys
+s = json.load(open(sys.argv[1]))
+p = s.get('progress') or {}
+print(f\"状态 {s.get('status')} | 准确率 {s.get('accuracy', 0):.2%} | 失败 {s.get('failed_inferences')} | \"
+      f\"{p.get('items_per_second')} 条/s | 预计剩余 {p.get('eta_seconds')}s | 更新于 {p.get('updated_at')}\")
+" "$STATS_FILE" 2>/dev/null
+    fi
+}
+
 # 记录进度
 record_progress() {
     echo "尝试 $retry_count: 完成 $1 条数据" >> "$PROGRESS_LOG"
@@ -42,6 +64,7 @@ while [ $retry_count -le $MAX_RETRIES ]; do
     # 检查输出文件行数
     new_lines=$(get_current_lines)
     echo "��� 运行后行数: $new_lines/$TARGET_LINES"
+    print_stats
     record_progress "$new_lines"
     
     # 检查是否完成
@@ -1,5 +1,9 @@
 ## model path填写模型地址##
 ## model name填写模型名字##
+## inference.py 使用 --image_transport file 时才需要允许服务端读取本地图像：把下面一行改为 LOCAL_MEDIA_FLAG="--allowed-local-media-path ${image root}"，image root填写图像根目录；默认的 base64 传输不需要，保持为空##
+LOCAL_MEDIA_FLAG=""
+## 自动前缀缓存：所有评测请求共用同一个系统提示，开启后这部分 KV 在样本之间复用；改为 --no-enable-prefix-caching 可关闭，用于对比##
+PREFIX_CACHING_FLAG="--enable-prefix-caching"
 export CUDA_VISIBLE_DEVICES=0,1,2,3,4,5
 VLLM_USE_V1=1 \
 VLLM_WORKER_MULTIPROC_METHOD=spawn \
@@ -10,3 +14,5 @@ vllm serve ${model path}  \
   --tensor-parallel-size 4 \
   --port 8999 \
   --max-parallel-loading-workers 8 \
+  ${LOCAL_MEDIA_FLAG} \
+  ${PREFIX_CACHING_FLAG} \
@@ -1,75 +1,278 @@
+#!/usr/bin/env python3
+"""
+GRPO 训练数据转换脚本
+把 Geo170K 格式的数据（JSON 列表或 JSONL）转换为 ms-swift 的消息格式，
+按样本内容的哈希确定性地划分训练集和测试集，一次遍历流式写出紧凑的 JSONL，
+内存占用与数据集大小无关
+
+可选的图像预处理阶段（--validate_images）在训练开始前并行检查每张图像是否
+存在且能解码，并把超过像素预算的图像预先缩放到缓存目录，坏样本被剔除并记录
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
 import json
+import math
 import os
-from sklearn.model_selection import train_test_split
+from PIL import Image
 
-# 输入和输出文件路径
-input_file = "geo170k_train_data.jsonl"
-train_output_file = "geo170k_train.json"
-test_output_file = "geo170k_test.json"
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='把 Geo170K 数据转换为 GRPO 训练用的 JSONL 并划分训练/测试集')
+    parser.add_argument('--input_file', type=str, default='geo170k_train_data.jsonl',
+                        help='输入文件（JSON 列表或 JSONL），默认: geo170k_train_data.jsonl')
+    parser.add_argument('--train_output_file', type=str, default='geo170k_train.jsonl',
+                        help='训练集输出文件，默认: geo170k_train.jsonl')
+    parser.add_argument('--test_output_file', type=str, default='geo170k_test.jsonl',
+                        help='测试集输出文件，默认: geo170k_test.jsonl')
+    parser.add_argument('--base_image_path', '--image_root', dest='base_image_path', type=str, default='XXXXX',
+                        help='图像根目录，拼接在 image_path 前面，检查图像时也从这里读取')
+    parser.add_argument('--test_size', type=float, default=0.05,
+                        help='测试集比例，默认: 0.05')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='划分用的哈希盐，相同的种子得到相同的划分，默认: 42')
+    parser.add_argument('--validate_images', action='store_true',
+                        help='检查每张图像是否存在且能解码，剔除坏样本')
+    parser.add_argument('--max_pixels', type=int, default=262144,
+                        help='像素预算，与训练时的 MAX_PIXELS 一致，默认: 262144')
+    parser.add_argument('--resize_cache_dir', type=str, default=None,
+                        help='超过像素预算的图像预先缩放后保存的目录，不指定则只检查不缩放')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(),
+                        help='图像检查/缩放的进程数')
+    parser.add_argument('--batch_size', type=int, default=1024,
+                        help='每批检查的样本数，默认: 1024')
+    parser.add_argument('--bad_records_file', type=str, default='bad_records.jsonl',
+                        help='坏样本及原因的输出文件，默认: bad_records.jsonl')
+    parser.add_argument('--keep_invalid', action='store_true',
+                        help='只报告坏样本，不从输出中剔除')
+    return parser.parse_args()
 
-# 基础图像路径前缀
-base_image_path = "XXXXX"
+def iter_json_array(f, chunk_size=1 << 20):
+    """增量解析 JSON 列表，逐个产出元素，不把整个文件读入内存"""
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size)
+    eof = not buf
+    pos = buf.index('[') + 1
+    while True:
+        # 跳过元素之间的空白和逗号
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            buf, pos = f.read(chunk_size), 0
+            eof = not buf
+        if pos >= len(buf):
+            raise ValueError("JSON 列表没有正常结束")
+        if buf[pos] == ']':
+            return
 
-# 尝试读取整个文件作为一个 JSON 列表
-with open(input_file, 'r') as f:
-    try:
-        data = json.load(f)
-        print(f"文件包含一个包含 {len(data)} 个元素的列表")
-
-        converted_data = []
-        for item in data:
-            if not isinstance(item, dict):
-                print(f"警告: 列表中的元素不是字典")
-                continue
-
-            if "problem" not in item or "image_path" not in item or "solution" not in item:
-                print(f"警告: 元素缺少必要的键")
-                continue
-
-            # 构建转换后的对象
-            converted_item = {
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": item["problem"] + "<image>"
-                    }
-                ],
-                "images": [
-                    os.path.join(base_image_path, item["image_path"])
-                ],
-                "solution": item["solution"]
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+            # 元素恰好结束在缓冲区末尾时可能不完整（例如被截断的数字），再读一块确认
+            if end == len(buf) and not eof:
+                raise ValueError
+        except ValueError:
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        yield obj
+        pos = end
+
+def iter_items(input_file):
+    """按文件内容自动识别 JSON 列表或 JSONL，逐条产出元素"""
+    with open(input_file, 'r', encoding='utf-8') as f:
+        first = ''
+        while True:
+            ch = f.read(1)
+            if not ch or not ch.isspace():
+                first = ch
+                break
+        f.seek(0)
+
+        if first == '[':
+            print("输入文件是 JSON 列表")
+            yield from iter_json_array(f)
+        else:
+            print("输入文件是 JSONL")
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    print(f"警告: 第 {line_no} 行不是有效的 JSON: {e}")
+
+def convert_item(item, base_image_path):
+    """构建转换后的对象，缺少必要字段时返回 None"""
+    if not isinstance(item, dict):
+        print(f"警告: 列表中的元素不是字典")
+        return None
+
+    if "problem" not in item or "image_path" not in item or "solution" not in item:
+        print(f"警告: 元素缺少必要的键")
+        return None
+
+    return {
+        "messages": [
+            {
+                "role": "user",
+                "content": item["problem"] + "<image>"
             }
+        ],
+        "images": [
+            os.path.join(base_image_path, item["image_path"])
+        ],
+        "solution": item["solution"]
+    }
+
+# 缩放插值方式，与 Qwen2-VL 图像处理器及 evaluation_script/inference.py 的 --max_pixels 一致，
+# 训练和评测看到相同的像素
+RESAMPLE = Image.BICUBIC
+
+def resized_cache_path(image_path, st, max_pixels, cache_dir):
+    """缩放后图像的缓存路径，由源文件路径、mtime/大小、像素预算和插值方式决定"""
+    raw = f"{os.path.abspath(image_path)}|{st.st_mtime_ns}|{st.st_size}|{max_pixels}|{RESAMPLE}"
+    key = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key[:2], f"{key}.png")
+
+def check_image(image_path, max_pixels, cache_dir=None):
+    """
+    检查图像并按需缩放
+
+    Returns:
+        tuple: (训练时使用的图像路径, 错误信息)；图像不可用时路径为 None
+    """
+    try:
+        st = os.stat(image_path)
+    except OSError:
+        return None, "图像不存在"
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = resized_cache_path(image_path, st, max_pixels, cache_dir)
+        if os.path.exists(cache_path):
+            return cache_path, None
+
+    try:
+        with Image.open(image_path) as img:
+            img.load()
+            width, height = img.size
+            if cache_path is None or width * height <= max_pixels:
+                return image_path, None
+
+            # 等比例缩放到像素预算以内
+            scale = math.sqrt(max_pixels / (width * height))
+            size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            resized = img.convert("RGB").resize(size, RESAMPLE)
+    except Exception as e:
+        return None, f"图像无法解码: {e}"
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    resized.save(tmp_path, format="PNG")
+    os.replace(tmp_path, cache_path)
+    return cache_path, None
+
+def check_images_batch(batch, args, executor, checked):
+    """
+    并行检查一批样本引用的图像，更新 checked 中的检查结果
 
-            converted_data.append(converted_item)
+    checked 以源图像路径为键缓存 (新路径, 错误)，同一张图只检查一次
+    """
+    pending = {}
+    for _, converted_item in batch:
+        for image_path in converted_item["images"]:
+            if image_path not in checked:
+                pending[image_path] = None
 
-    except json.JSONDecodeError as e:
+    results = executor.map(check_image, pending, itertools.repeat(args.max_pixels),
+                           itertools.repeat(args.resize_cache_dir), chunksize=16)
+    for image_path, result in zip(pending, results):
+        checked[image_path] = result
+
+def is_test_item(item, test_size, seed):
+    """根据样本内容的哈希确定样本属于测试集还是训练集"""
+    content = json.dumps([item["problem"], item["image_path"], item["solution"]], ensure_ascii=False)
+    digest = hashlib.sha256(f"{seed}:{content}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64 < test_size
+
+def main():
+    """主函数"""
+    args = parse_arguments()
+
+    train_count = 0
+    test_count = 0
+    bad_count = 0
+    resized_count = 0
+    checked = {}
+    executor = None
+    if args.validate_images:
+        print(f"检查图像（像素预算 {args.max_pixels}），使用 {args.num_workers} 个进程")
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.num_workers)
+    try:
+        with open(args.train_output_file, 'w', encoding='utf-8') as train_f, \
+                open(args.test_output_file, 'w', encoding='utf-8') as test_f, \
+                open(args.bad_records_file if args.validate_images else os.devnull, 'w', encoding='utf-8') as bad_f:
+            converted = ((item, convert_item(item, args.base_image_path)) for item in iter_items(args.input_file))
+            converted = ((item, c) for item, c in converted if c is not None)
+            while True:
+                batch = list(itertools.islice(converted, args.batch_size))
+                if not batch:
+                    break
+                if executor is not None:
+                    check_images_batch(batch, args, executor, checked)
+
+                for item, converted_item in batch:
+                    if executor is not None:
+                        errors = [f"{p}: {checked[p][1]}" for p in converted_item["images"] if checked[p][0] is None]
+                        if errors:
+                            bad_count += 1
+                            bad_f.write(json.dumps({"item": item, "errors": errors}, ensure_ascii=False) + '\n')
+                            if not args.keep_invalid:
+                                continue
+                        else:
+                            new_images = [checked[p][0] for p in converted_item["images"]]
+                            resized_count += sum(1 for p, n in zip(converted_item["images"], new_images) if p != n)
+                            converted_item["images"] = new_images
+
+                    line = json.dumps(converted_item, ensure_ascii=False, separators=(',', ':')) + '\n'
+                    if is_test_item(item, args.test_size, args.seed):
+                        test_f.write(line)
+                        test_count += 1
+                    else:
+                        train_f.write(line)
+                        train_count += 1
+    except (ValueError, json.JSONDecodeError) as e:
         print(f"错误: 文件不是有效的 JSON: {e}")
         exit()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if args.validate_images:
+        print(f"图像检查完成: 坏样本 {bad_count} 条{'（已保留）' if args.keep_invalid else '（已剔除）'}，"
+              f"使用缩放后图像 {resized_count} 张")
+        if bad_count:
+            print(f"坏样本已记录到 {args.bad_records_file}")
+
+    total = train_count + test_count
+    print(f"成功处理 {total} 条有效数据")
+
+    if total == 0:
+        print("没有有效数据可处理")
+        exit()
+
+    print(f"转换完成！共处理 {total} 条数据。")
+    print(f"训练集: {train_count} 条数据")
+    print(f"测试集: {test_count} 条数据")
+    print(f"训练集已保存到 {args.train_output_file}")
+    print(f"测试集已保存到 {args.test_output_file}")
 
-# 其余代码保持不变...
-print(f"成功处理 {len(converted_data)} 条有效数据")
-
-if len(converted_data) == 0:
-    print("没有有效数据可处理，退出程序")
-    exit()
-
-# 分割数据集
-train_data, test_data = train_test_split(
-    converted_data,
-    test_size=0.05,
-    random_state=42  # 设置随机种子以确保结果可重现
-)
-
-# 将训练集数据写入文件
-with open(train_output_file, 'w') as f:
-    json.dump(train_data, f, indent=2)
-
-# 将测试集数据写入文件
-with open(test_output_file, 'w') as f:
-    json.dump(test_data, f, indent=2)
-
-print(f"转换完成！共处理 {len(converted_data)} 条数据。")
-print(f"训练集: {len(train_data)} 条数据")
-print(f"测试集: {len(test_data)} 条数据")
-print(f"训练集已保存到 {train_output_file}")
-print(f"测试集已保存到 {test_output_file}")
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@ Parquet 数据解析脚本
 并生成 JSONL 格式的输出
 """
 
-import pandas as pd
+import pyarrow.parquet as pq
 import json
 from PIL import Image
 import io
@@ -13,12 +13,20 @@ import os
 import argparse
 from pathlib import Path
 import base64
+import glob
+import hashlib
+import itertools
+import struct
+import collections
+import concurrent.futures
+import math
 import numpy as np
 
 def parse_arguments():
     """解析命令行参数"""
     parser = argparse.ArgumentParser(description='解析包含图像和嵌套数据的Parquet文件并生成JSONL')
-    parser.add_argument('input_file', type=str, help='输入的Parquet文件路径')
+    parser.add_argument('input_file', type=str,
+                       help='输入的Parquet文件路径；也可以是目录或通配符，此时按分片并行转换')
     parser.add_argument('--output_dir', type=str, default='./output',
                        help='输出目录路径，默认: ./output')
     parser.add_argument('--image_dir', type=str, default='images',
@@ -27,6 +35,22 @@ def parse_arguments():
                        help='最大处理行数（用于测试），默认: 处理所有行')
     parser.add_argument('--embed_images', action='store_true',
                        help='将图像嵌入JSONL中（Base64编码），而不是保存为文件')
+    parser.add_argument('--stream', action='store_true',
+                       help='流式模式：按 record batch 读取并逐条写出，内存占用只与批大小有关')
+    parser.add_argument('--batch_size', type=int, default=256,
+                       help='每批读取/处理的行数，默认: 256')
+    parser.add_argument('--image_workers', type=int, default=1,
+                       help='图像处理进程数，大于1时并行解码/保存图像，默认: 1（串行）')
+    parser.add_argument('--no_passthrough', action='store_true',
+                       help='总是用 PIL 解码并重新编码图像，默认已是目标格式的图像直接写出原始字节')
+    parser.add_argument('--chunk_size', type=int, default=None,
+                       help='每次提交给图像处理进程的图像数，默认按进程数自动计算（每个进程约 4 块）')
+    parser.add_argument('--prefetch_batches', type=int, default=2,
+                       help='并行处理图像时提前提交的批数，写出当前批时进程池继续处理后续批，默认: 2')
+    parser.add_argument('--dedup_images', action='store_true',
+                       help='按图像内容哈希保存（images/ab/<sha256>.png），相同图像只写一次')
+    parser.add_argument('--shard_workers', type=int, default=1,
+                       help='多文件输入时并行转换的分片数，默认: 1')
     return parser.parse_args()
 
 def ensure_dir(path):
@@ -34,15 +58,64 @@ def ensure_dir(path):
     Path(path).mkdir(parents=True, exist_ok=True)
     return path
 
-def process_image_data(img_data, index, save_dir=None, embed=False):
+# 常见图像格式的文件头，格式名与 PIL 的 Image.format 一致
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+]
+
+def sniff_image_format(img_bytes):
+    """根据文件头判断图像格式，无法识别时返回 None"""
+    if img_bytes[:4] == b"RIFF" and img_bytes[8:12] == b"WEBP":
+        return "WEBP"
+    for signature, fmt in IMAGE_SIGNATURES:
+        if img_bytes.startswith(signature):
+            return fmt
+    return None
+
+def read_image_info(img_bytes, fmt=None):
+    """只读取文件头获得图像 (宽, 高, 格式)，不解码像素"""
+    if fmt == "PNG" and img_bytes[12:16] == b"IHDR":
+        return struct.unpack(">II", img_bytes[16:24]) + ("PNG",)
+    if fmt == "GIF":
+        return struct.unpack("<HH", img_bytes[6:10]) + ("GIF",)
+    # 其他格式用 PIL 惰性打开，只解析文件头
+    with Image.open(io.BytesIO(img_bytes)) as image:
+        return image.width, image.height, image.format
+
+def content_addressed_path(save_dir, digest):
+    """内容寻址存储中图像的路径：按哈希前两位分子目录"""
+    return os.path.join(save_dir, digest[:2], f"{digest}.png")
+
+def write_file_atomic(filepath, data):
+    """先写临时文件再原子替换，多个进程写入同一内容时不会互相破坏"""
+    ensure_dir(os.path.dirname(filepath))
+    tmp_path = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, filepath)
+
+def process_image_data(img_data, index, save_dir=None, embed=False, passthrough=True, dedup=False):
     """
     处理图像数据：保存为文件或编码为Base64
 
+    passthrough 为 True 时，已经是目标格式的图像（保存文件时为 PNG，嵌入时
+    为任意可识别的格式）直接写出原始字节，不经过 PIL 解码和重新编码，
+    只有格式不符时才转码。
+
+    dedup 为 True 时（仅保存文件时有效）按原始字节的 sha256 把图像保存到
+    内容寻址路径，相同的图像只写一次，已存在时跳过解码和写入。
+
     Args:
         img_data: 图像数据字典
         index: 索引，用于命名
         save_dir: 图片保存的目录（如果不嵌入）
         embed: 是否将图像嵌入JSONL中
+        passthrough: 是否对目标格式的图像直接透传原始字节
+        dedup: 是否使用内容寻址存储去重
 
     Returns:
         dict: 包含图像信息的字典
@@ -51,6 +124,46 @@ def process_image_data(img_data, index, save_dir=None, embed=False):
         # 获取二进制数据
         img_bytes = img_data['bytes']
 
+        digest = None
+        if not embed:
+            if dedup:
+                digest = hashlib.sha256(img_bytes).hexdigest()
+                filepath = content_addressed_path(save_dir, digest)
+            else:
+                filepath = os.path.join(save_dir, f"image_{index}.png")
+
+        # 内容寻址存储中已有同样的图像，只读文件头
+        if digest is not None and os.path.exists(filepath):
+            width, height, fmt = read_image_info(img_bytes, sniff_image_format(img_bytes))
+            return {
+                "width": width,
+                "height": height,
+                "format": fmt,
+                "path": filepath,
+                "sha256": digest
+            }
+
+        fmt = sniff_image_format(img_bytes) if passthrough else None
+        if fmt is not None and (embed or fmt == "PNG"):
+            width, height, fmt = read_image_info(img_bytes, fmt)
+            result = {
+                "width": width,
+                "height": height,
+                "format": fmt
+            }
+            if embed:
+                img_base64 = base64.b64encode(img_bytes).decode('utf-8')
+                result["data"] = f"data:image/{fmt.lower()};base64,{img_base64}"
+            elif digest is not None:
+                write_file_atomic(filepath, img_bytes)
+                result["path"] = filepath
+                result["sha256"] = digest
+            else:
+                with open(filepath, "wb") as f:
+                    f.write(img_bytes)
+                result["path"] = filepath
+            return result
+
         # 使用 PIL 和 BytesIO 打开图片
         image = Image.open(io.BytesIO(img_bytes))
 
@@ -66,10 +179,14 @@ def process_image_data(img_data, index, save_dir=None, embed=False):
             image.save(buffered, format=image.format or "PNG")
             img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
             result["data"] = f"data:image/{image.format.lower() or 'png'};base64,{img_base64}"
+        elif digest is not None:
+            buffered = io.BytesIO()
+            image.save(buffered, format="PNG")
+            write_file_atomic(filepath, buffered.getvalue())
+            result["path"] = filepath
+            result["sha256"] = digest
         else:
             # 保存为文件
-            filename = f"image_{index}.png"
-            filepath = os.path.join(save_dir, filename)
             image.save(filepath)
             result["path"] = filepath
 
@@ -117,6 +234,10 @@ def custom_serializer(obj):
         return obj.tolist()
     elif isinstance(obj, np.bool_):
         return bool(obj)
+    elif isinstance(obj, bytes):
+        return base64.b64encode(obj).decode('utf-8')
+    elif hasattr(obj, 'isoformat'):
+        return obj.isoformat()
     elif hasattr(obj, '__dict__'):
         return obj.__dict__
     else:
@@ -141,116 +262,438 @@ def clean_data(value):
     else:
         return value
 
-def main():
-    """主函数"""
-    # 解析命令行参数
-    args = parse_arguments()
+def process_image_chunk(tasks, image_dir=None, embed=False, passthrough=True, dedup=False):
+    """在子进程中处理一块图像，tasks 为 [(图像数据, 索引)]"""
+    return [process_image_data(img_data, index, image_dir, embed, passthrough, dedup) for img_data, index in tasks]
 
-    # 确保输出目录存在
-    output_dir = ensure_dir(args.output_dir)
+def auto_chunk_size(num_tasks, num_workers):
+    """按进程数确定每块图像数：每个进程约分到 4 块，兼顾负载均衡和提交开销"""
+    return max(1, math.ceil(num_tasks / (max(num_workers, 1) * 4)))
 
-    # 如果不嵌入图像，确保图像目录存在
-    if not args.embed_images:
-        image_dir = ensure_dir(os.path.join(output_dir, args.image_dir))
+def submit_images_batch(rows, image_dir=None, embed=False, executor=None, chunksize=None, passthrough=True,
+                        dedup=False, num_workers=1):
+    """
+    提交一批行中的全部图像
 
-    # 读取Parquet文件
-    print(f"正在读取Parquet文件: {args.input_file}")
-    try:
-        df = pd.read_parquet(args.input_file, engine='pyarrow')
+    有进程池时按块提交后立即返回，调用方可以在处理结果前继续提交后续批次；
+    没有进程池时直接在当前进程中处理。
 
-        # 如果指定了最大行数，只处理部分数据
-        if args.max_rows and args.max_rows < len(df):
-            df = df.head(args.max_rows)
-            print(f"只处理前 {args.max_rows} 行数据")
+    Returns:
+        tuple: (每行的图像数（读取图像列表出错的行为 None）, 按顺序排列的块结果或 future 列表)
+    """
+    tasks = []
+    counts = []
+    for idx, row in rows:
+        try:
+            img_list = list(row.get('images', []))
+        except Exception as e:
+            print(f"错误: 读取第 {idx} 行图像列表时出错: {str(e)}")
+            counts.append(None)
+            continue
+        counts.append(len(img_list))
+        for img_idx, img_data in enumerate(img_list):
+            tasks.append((img_data, f"{idx}_{img_idx}"))
 
-    except Exception as e:
-        print(f"错误: 无法读取Parquet文件: {str(e)}")
-        return
+    if executor is None:
+        return counts, [process_image_chunk(tasks, image_dir, embed, passthrough, dedup)]
+    chunksize = chunksize or auto_chunk_size(len(tasks), num_workers)
+    return counts, [executor.submit(process_image_chunk, tasks[i:i + chunksize], image_dir, embed, passthrough, dedup)
+                    for i in range(0, len(tasks), chunksize)]
 
-    print(f"成功读取数据，共 {len(df)} 行")
+def collect_images_batch(counts, chunks):
+    """
+    按顺序取回 submit_images_batch 的结果
 
-    # 准备JSONL数据
-    jsonl_data = []
+    Returns:
+        list: 与 rows 一一对应的图像结果列表，读取图像列表出错的行为 None
+    """
+    results = itertools.chain.from_iterable(
+        chunk.result() if isinstance(chunk, concurrent.futures.Future) else chunk for chunk in chunks
+    )
+    return [None if count is None else list(itertools.islice(results, count)) for count in counts]
 
-    # 处理每一行数据
-    print("正在处理数据并生成JSONL...")
-    for idx, row in df.iterrows():
+def build_record(idx, row, images):
+    """把一行数据和已处理好的图像结果转换为可以 JSON 序列化的记录
+
+    row 中的标量列已经由 batch_to_rows 按列转换为原生 Python 类型。
+    """
+    # 基础数据
+    record = {
+        "id": idx,
+        "problem": row.get('problem', ''),
+        "answer": row.get('answer', ''),
+        "data_source": row.get('data_source', ''),
+        "prompt": row.get('prompt', ''),
+        "ability": row.get('ability', ''),
+        "reward_model": row.get('reward_model', '')
+    }
+
+    # 图像数据
+    record["images"] = images
+
+    # 解析extra_info（可能是 JSON 字符串），清理后确保可以被JSON序列化
+    extra_info = row.get('extra_info', {})
+    parsed_extra_info = parse_extra_info(extra_info)
+    record["extra_info"] = clean_data(parsed_extra_info)
+
+    return record
+
+def write_record(f, record):
+    """写入一条JSONL记录，序列化失败时退回到严格清理"""
+    try:
+        f.write(json.dumps(record, ensure_ascii=False, default=custom_serializer) + '\n')
+    except TypeError as e:
+        print(f"错误: 无法序列化记录 {record.get('id', 'unknown')}: {str(e)}")
+        # 尝试使用更严格的清理
         try:
-            # 基础数据
-            record = {
-                "id": idx,
-                "problem": row.get('problem', ''),
-                "answer": row.get('answer', ''),
-                "data_source": row.get('data_source', ''),
-                "prompt": row.get('prompt', ''),
-                "ability": row.get('ability', ''),
-                "reward_model": row.get('reward_model', '')
-            }
+            # 创建一个新的清理后的记录
+            strict_cleaned_record = {}
+            for k, v in record.items():
+                # 只保留基本类型和字符串
+                if isinstance(v, (str, int, float, bool)) or v is None:
+                    strict_cleaned_record[k] = v
+                elif isinstance(v, (list, dict)):
+                    # 尝试转换为字符串
+                    strict_cleaned_record[k] = str(v)
+            f.write(json.dumps(strict_cleaned_record, ensure_ascii=False) + '\n')
+        except Exception as e2:
+            print(f"严重错误: 无法序列化记录 {record.get('id', 'unknown')} 即使经过严格清理: {str(e2)}")
+
+# 直接写入记录的标量列；images 和 extra_info 需要逐行处理
+SCALAR_COLUMNS = ['problem', 'answer', 'data_source', 'prompt', 'ability', 'reward_model']
+ROW_COLUMNS = ['images', 'extra_info']
+
+def batch_to_rows(batch, start_idx):
+    """
+    按列把 pyarrow 的 Table/RecordBatch 转为 Python 对象
 
-            # 处理图像数据
-            img_list = row.get('images', [])
-            record["images"] = []
+    每列只调用一次 to_pylist，由 pyarrow 直接生成原生 Python 类型（嵌套的
+    list/struct 也一样），标量列不再需要逐个值递归 clean_data。
 
-            for img_idx, img_data in enumerate(img_list):
-                if args.embed_images:
-                    img_result = process_image_data(img_data, f"{idx}_{img_idx}", embed=True)
-                else:
-                    img_result = process_image_data(img_data, f"{idx}_{img_idx}", image_dir, embed=False)
+    Returns:
+        list: [(行号, 行字典)]
+    """
+    names = set(batch.schema.names)
+    columns = {name: batch.column(name).to_pylist()
+               for name in SCALAR_COLUMNS + ROW_COLUMNS if name in names}
+    return [(start_idx + i, {name: values[i] for name, values in columns.items()})
+            for i in range(batch.num_rows)]
+
+def iter_rows_streaming(input_file, batch_size, max_rows=None, id_offset=0):
+    """按 record batch 流式读取 Parquet，产出 (行号, 行)；达到 max_rows 后立即停止读取"""
+    parquet_file = pq.ParquetFile(input_file)
+    idx = 0
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        if max_rows is not None and idx + batch.num_rows > max_rows:
+            batch = batch.slice(0, max_rows - idx)
+        yield from batch_to_rows(batch, id_offset + idx)
+        idx += batch.num_rows
+        if max_rows is not None and idx >= max_rows:
+            return
+
+def iter_rows(input_file, max_rows=None, id_offset=0):
+    """一次性读取整个 Parquet 文件，产出 (行号, 行)"""
+    table = pq.read_table(input_file)
+
+    # 如果指定了最大行数，只处理部分数据
+    if max_rows and max_rows < table.num_rows:
+        table = table.slice(0, max_rows)
+        print(f"只处理前 {max_rows} 行数据")
+
+    print(f"成功读取数据，共 {table.num_rows} 行")
+    return iter(batch_to_rows(table, id_offset))
+
+def convert_file(input_file, jsonl_path, image_dir, args, id_offset=0):
+    """
+    把一个 Parquet 文件转换为 JSONL
 
-                record["images"].append(img_result)
+    Args:
+        input_file: 输入的Parquet文件
+        jsonl_path: 输出的JSONL文件
+        image_dir: 图像保存目录（嵌入图像时为 None）
+        args: 命令行参数
+        id_offset: 记录 id 的起始值，多分片时保证 id 全局唯一
 
-            # 解析extra_info
-            extra_info = row.get('extra_info', {})
-            parsed_extra_info = parse_extra_info(extra_info)
-            record["extra_info"] = parsed_extra_info
+    Returns:
+        tuple: (写出的记录数, 前5条样本记录, 引用的图像数, 图像哈希集合)
+    """
+    if args.stream:
+        print(f"流式模式，每批 {args.batch_size} 行")
+        rows = iter_rows_streaming(input_file, args.batch_size, args.max_rows, id_offset)
+    else:
+        rows = iter_rows(input_file, args.max_rows, id_offset)
+
+    sample_records = []
+    num_records = 0
+    num_images = 0
+    image_hashes = set()
+    executor = None
+    if args.image_workers > 1:
+        print(f"使用 {args.image_workers} 个进程处理图像")
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.image_workers)
+    try:
+        with open(jsonl_path, 'w', encoding='utf-8') as f:
+            # 有进程池时保持 prefetch_batches 个后续批次在途，进程池不会因为
+            # 等待当前批写出而空闲
+            window = collections.deque()
+            prefetch = args.prefetch_batches if executor is not None else 0
+            exhausted = False
+            while True:
+                while not exhausted and len(window) <= prefetch:
+                    batch = list(itertools.islice(rows, args.batch_size))
+                    if not batch:
+                        exhausted = True
+                        break
+                    window.append((batch, submit_images_batch(batch, image_dir, args.embed_images, executor,
+                                                              args.chunk_size, not args.no_passthrough,
+                                                              args.dedup_images, args.image_workers)))
+                if not window:
+                    break
+                batch, submitted = window.popleft()
+                batch_images = collect_images_batch(*submitted)
+
+                for (idx, row), images in zip(batch, batch_images):
+                    if images is None:
+                        continue
+                    for img in images:
+                        if "sha256" in img:
+                            num_images += 1
+                            image_hashes.add(img["sha256"])
+                    try:
+                        record = build_record(idx, row, images)
+                    except Exception as e:
+                        print(f"错误: 处理第 {idx} 行时出错: {str(e)}")
+                        continue
+
+                    write_record(f, record)
+                    num_records += 1
+                    if len(sample_records) < 5:
+                        sample_records.append(record)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return num_records, sample_records, num_images, image_hashes
+
+def report_dedup(num_images, image_hashes):
+    """打印内容寻址存储的去重情况"""
+    unique = len(image_hashes)
+    ratio = num_images / unique if unique else 1.0
+    print(f"图像引用数: {num_images}，唯一图像数: {unique}，去重比: {ratio:.2f}x")
+
+def save_sample(output_dir, sample_records):
+    """保存一份样本文件（前5条记录）"""
+    sample_path = os.path.join(output_dir, 'sample.json')
+    with open(sample_path, 'w', encoding='utf-8') as f:
+        json.dump(sample_records, f, ensure_ascii=False, indent=2, default=custom_serializer)
+    print(f"样本数据已保存至: {sample_path}")
 
-            # 清理记录，确保所有数据都可以被JSON序列化
-            cleaned_record = {}
-            for k, v in record.items():
-                cleaned_record[k] = clean_data(v)
+def resolve_input_files(input_path):
+    """把输入解析为 Parquet 文件列表：文件、目录（其中全部 .parquet）或通配符"""
+    if os.path.isdir(input_path):
+        return sorted(glob.glob(os.path.join(input_path, '*.parquet')))
+    if os.path.isfile(input_path):
+        return [input_path]
+    return sorted(glob.glob(input_path))
+
+def file_sha256(path):
+    """计算文件的 sha256"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def shard_output_name(source):
+    """分片输出文件名：由源文件名和绝对路径的哈希决定，与分片数量和排序无关"""
+    stem = os.path.splitext(os.path.basename(source))[0]
+    digest = hashlib.sha1(os.path.abspath(source).encode('utf-8')).hexdigest()[:8]
+    return f"data-{stem}-{digest}.jsonl"
+
+def convert_shard(shard):
+    """在子进程中转换单个分片，返回写入清单的分片信息"""
+    num_records, sample_records, num_images, image_hashes = convert_file(
+        shard["source"], shard["output"], shard["image_dir"], shard["args"], shard["id_offset"]
+    )
+    return {
+        "source": shard["source"],
+        "source_size": shard["source_size"],
+        "source_mtime_ns": shard["source_mtime_ns"],
+        "source_rows": shard["source_rows"],
+        "id_offset": shard["id_offset"],
+        "options": shard["options"],
+        "output": os.path.basename(shard["output"]),
+        "output_size": os.path.getsize(shard["output"]),
+        "output_sha256": file_sha256(shard["output"]),
+        "num_records": num_records,
+        "num_images": num_images,
+        "unique_images": len(image_hashes),
+        "sample_records": sample_records,
+        "image_hashes": image_hashes,
+    }
+
+def write_manifest(manifest_path, manifest):
+    """原子地写入清单文件"""
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def convert_shards(input_files, output_dir, image_dir, args):
+    """
+    并行转换多个 Parquet 分片
+
+    每个分片输出 data-<源文件名>-<路径哈希>.jsonl，文件名只由源文件决定，
+    增删分片不会改变其他分片的输出。记录 id 的起始值记录在 manifest.json
+    中：已转换的分片沿用原来的起始值，新分片（或行数变化的分片）从现有
+    最大 id 之后分配，id 和图像文件名因此全局唯一且在重跑之间保持不变。
+    manifest.json 记录每个分片的行数和校验和；源文件、id 起始值、转换选项
+    和输出文件都未变化的分片在重跑时直接跳过。源文件不在本次输入中的分片
+    保留输出文件和清单条目，只标记为 stale 并且不计入 total_records（之后
+    重新输入时直接跳过）；旧版本按序号命名、源文件在本次输入中的输出已被
+    新文件取代，会被删除。
+    """
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    manifest = {"shards": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+
+    current = {shard_output_name(source) for source in input_files}
+    current_sources = set(input_files)
+    for name, entry in list(manifest["shards"].items()):
+        if name in current:
+            entry.pop("stale", None)
+        elif entry.get("source") in current_sources:
+            # 旧版本按序号命名的输出，本次会按源文件名重新输出
+            del manifest["shards"][name]
+            legacy_output = os.path.join(output_dir, name)
+            if os.path.exists(legacy_output):
+                os.remove(legacy_output)
+            print(f"移除旧命名的分片输出: {name}")
+        elif not entry.get("stale"):
+            entry["stale"] = True
+            print(f"警告: 分片 {name} 的源文件不在本次输入中，保留其输出但不计入 total_records")
+
+    options = {
+        "embed_images": args.embed_images,
+        "image_dir": args.image_dir,
+        "max_rows": args.max_rows,
+        "passthrough": not args.no_passthrough,
+        "dedup_images": args.dedup_images,
+    }
+    num_shards = len(input_files)
+    shards = []
+    skipped = 0
+    next_offset = max((e["id_offset"] + e["source_rows"] for e in manifest["shards"].values()), default=0)
+    for source in input_files:
+        st = os.stat(source)
+        source_rows = pq.ParquetFile(source).metadata.num_rows
+        output = os.path.join(output_dir, shard_output_name(source))
+        entry = manifest["shards"].get(os.path.basename(output))
+        if entry is not None and entry.get("source_rows") == source_rows:
+            id_offset = entry["id_offset"]
+        else:
+            id_offset = next_offset
+            next_offset += source_rows
+        shard = {
+            "source": source,
+            "source_size": st.st_size,
+            "source_mtime_ns": st.st_mtime_ns,
+            "source_rows": source_rows,
+            "id_offset": id_offset,
+            "options": options,
+            "output": output,
+        }
 
-            # 添加到JSONL数据列表
-            jsonl_data.append(cleaned_record)
+        if (entry is not None and os.path.exists(output)
+                and all(entry.get(k) == shard[k] for k in
+                        ("source", "source_size", "source_mtime_ns", "id_offset", "options"))
+                and entry.get("output_size") == os.path.getsize(output)):
+            skipped += 1
+            continue
+        # 重新转换期间旧的条目已失效，转换失败时不再计入 total_records
+        manifest["shards"].pop(os.path.basename(output), None)
+        shard["image_dir"] = image_dir
+        shard["args"] = args
+        shards.append(shard)
+    write_manifest(manifest_path, manifest)
+
+    print(f"共 {num_shards} 个分片，{skipped} 个已转换，待转换 {len(shards)} 个")
+
+    sample_records = None
+    num_images = 0
+    image_hashes = set()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.shard_workers) as executor:
+        futures = {executor.submit(convert_shard, shard): shard for shard in shards}
+        for future in concurrent.futures.as_completed(futures):
+            shard = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                print(f"错误: 转换分片 {shard['source']} 时出错: {str(e)}")
+                continue
+            if sample_records is None or entry["id_offset"] == 0:
+                sample_records = entry["sample_records"]
+            del entry["sample_records"]
+            num_images += entry["num_images"]
+            image_hashes |= entry.pop("image_hashes")
+            manifest["shards"][entry["output"]] = entry
+            write_manifest(manifest_path, manifest)
+            print(f"分片完成: {shard['source']} -> {entry['output']} ({entry['num_records']} 条)")
+
+    manifest["total_records"] = sum(e["num_records"] for e in manifest["shards"].values() if not e.get("stale"))
+    write_manifest(manifest_path, manifest)
+    print(f"处理完成! 全部分片共 {manifest['total_records']} 条记录")
+    print(f"清单文件已保存至: {manifest_path}")
+    if args.dedup_images:
+        report_dedup(num_images, image_hashes)
+    return sample_records
 
+def main():
+    """主函数"""
+    # 解析命令行参数
+    args = parse_arguments()
+
+    # 确保输出目录存在
+    output_dir = ensure_dir(args.output_dir)
+
+    # 如果不嵌入图像，确保图像目录存在
+    image_dir = None
+    if not args.embed_images:
+        image_dir = ensure_dir(os.path.join(output_dir, args.image_dir))
+
+    input_files = resolve_input_files(args.input_file)
+    if not input_files:
+        print(f"错误: 没有找到输入文件: {args.input_file}")
+        return
+
+    if not os.path.isfile(args.input_file):
+        # 多文件：分片并行转换
+        sample_records = convert_shards(input_files, output_dir, image_dir, args)
+    else:
+        # 读取Parquet文件，处理每一行数据并逐条写出JSONL
+        print(f"正在读取Parquet文件: {input_files[0]}")
+        print("正在处理数据并生成JSONL...")
+        jsonl_path = os.path.join(output_dir, 'data.jsonl')
+        try:
+            num_records, sample_records, num_images, image_hashes = convert_file(
+                input_files[0], jsonl_path, image_dir, args
+            )
         except Exception as e:
-            print(f"错误: 处理第 {idx} 行时出错: {str(e)}")
-            continue
+            print(f"错误: 无法读取Parquet文件: {str(e)}")
+            return
 
-    # 保存JSONL文件
-    jsonl_path = os.path.join(output_dir, 'data.jsonl')
-    with open(jsonl_path, 'w', encoding='utf-8') as f:
-        for record in jsonl_data:
-            try:
-                f.write(json.dumps(record, ensure_ascii=False, default=custom_serializer) + '\n')
-            except TypeError as e:
-                print(f"错误: 无法序列化记录 {record.get('id', 'unknown')}: {str(e)}")
-                # 尝试使用更严格的清理
-                try:
-                    # 创建一个新的清理后的记录
-                    strict_cleaned_record = {}
-                    for k, v in record.items():
-                        # 只保留基本类型和字符串
-                        if isinstance(v, (str, int, float, bool)) or v is None:
-                            strict_cleaned_record[k] = v
-                        elif isinstance(v, (list, dict)):
-                            # 尝试转换为字符串
-                            strict_cleaned_record[k] = str(v)
-                    f.write(json.dumps(strict_cleaned_record, ensure_ascii=False) + '\n')
-                except Exception as e2:
-                    print(f"严重错误: 无法序列化记录 {record.get('id', 'unknown')} 即使经过严格清理: {str(e2)}")
-
-    print(f"处理完成!")
-    print(f"JSONL文件已保存至: {jsonl_path}")
+        print(f"处理完成! 共写出 {num_records} 条记录")
+        print(f"JSONL文件已保存至: {jsonl_path}")
+        if args.dedup_images:
+            report_dedup(num_images, image_hashes)
 
     if not args.embed_images:
         print(f"图像文件已保存至: {image_dir}")
 
-    # 同时保存一份样本文件（前5条记录）
-    sample_path = os.path.join(output_dir, 'sample.json')
-    with open(sample_path, 'w', encoding='utf-8') as f:
-        json.dump(jsonl_data[:5], f, ensure_ascii=False, indent=2, default=custom_serializer)
-
-    print(f"样本数据已保存至: {sample_path}")
+    if sample_records is not None:
+        save_sample(output_dir, sample_records)
 
 if __name__ == "__main__":
     main()